@@ -0,0 +1,41 @@
+'''
+Attention statistics of the training minibatches, from the outputs of
+f_grad_shared: the update returns the alpha ratio (mean min over mean max
+of the attention weights over the frames) and the mean of the betas, so
+reporting them costs no forward pass of its own.
+'''
+
+
+def attention_outputs(alphas, betas, mask):
+    '''
+    Scalars added to the outputs of f_grad_shared, and betas[:, 0], the
+    beta of every word of the first caption, for the display.
+    '''
+    ratio = alphas.min(-1).mean() / alphas.max(-1).mean()
+    betas_mean = ((betas * mask).sum(0) / mask.sum(0)).mean()
+    return [ratio, betas_mean, betas[:, 0]]
+
+
+class AttentionStats(object):
+    '''
+    Running sums over the minibatches; every reader (the display, the
+    validation) gets the means over the minibatches since it last asked.
+    '''
+    def __init__(self):
+        self.ratio = 0.
+        self.betas_mean = 0.
+        self.n = 0
+        # reader -> sums when it last asked
+        self.marks = {}
+
+    def update(self, ratio, betas_mean):
+        self.ratio += float(ratio)
+        self.betas_mean += float(betas_mean)
+        self.n += 1
+
+    def report(self, reader):
+        # (alpha ratio, betas mean) over the minibatches since the last call
+        ratio, betas_mean, n = self.marks.get(reader, (0., 0., 0))
+        self.marks[reader] = (self.ratio, self.betas_mean, self.n)
+        n = max(self.n - n, 1)
+        return (self.ratio - ratio) / n, (self.betas_mean - betas_mean) / n
@@ -0,0 +1,202 @@
+'''
+Background checkpoint writer: train() hands over a snapshot of the
+parameters and goes on with the next update while a thread writes it.
+Every file is written to <name>.tmp and renamed into place, so a reader
+or a crash never sees a half written checkpoint.
+
+resume.npz holds everything else a preempted job needs to go on exactly
+where it stopped: the optimizer accumulators, the loop counters and the
+state of the random streams.
+'''
+import cPickle as pkl
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from Queue import Queue
+
+import numpy
+
+import utils
+
+RESUME_FILE = 'resume.npz'
+
+
+class CheckpointWriter(object):
+    def __init__(self, save_dir, compress=False, keep_last=3, max_pending=2,
+                 enabled=True, log=None, rotating_pattern=r'model_(\d+)\.npz$',
+                 adopt=False):
+        '''
+        compress: numpy.savez_compressed instead of numpy.savez.
+        keep_last: rotating checkpoints kept on disk, older ones are
+                   removed unless pinned; 0 keeps them all.
+        max_pending: snapshots waiting to be written, save() blocks
+                     beyond that rather than piling up copies of the
+                     parameters in memory.
+        enabled: False makes save() a no-op, for the workers of a
+                 data-parallel run other than rank 0.
+        log: a TrainingLog, gets the time of every write and the time
+             save() held up training.
+        rotating_pattern: names of the rotating checkpoints, its group the
+                          number they are ordered by.
+        adopt: the rotating checkpoints already in save_dir go under the
+               policy as well, for a run resuming from there; otherwise
+               only those written by this writer do.
+        '''
+        self.save_dir = save_dir
+        self.enabled = enabled
+        self.log = log
+        self.compress = compress
+        self.keep_last = keep_last
+        # rotating checkpoints on disk, oldest first
+        self.rotating = []
+        self.pinned = set()
+        if enabled and adopt and os.path.isdir(save_dir):
+            self._find_rotating(rotating_pattern)
+        self._queue = Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._work, name='checkpoint')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, name, params, rotate=False, pin=False, aliases=(), **extra):
+        '''
+        Queue params (and extra arrays, e.g. history_errs) for writing to
+        save_dir/name. rotate puts the file under the keep_last policy,
+        pin keeps it whatever the policy. aliases are other names for
+        the same file, e.g. model_current.npz for the last model_<uidx>.npz.
+        '''
+        self._check()
+        if not self.enabled:
+            return
+        t0 = time.time()
+        # snapshot now, the caller keeps changing history_errs and friends
+        arrays = dict((k, numpy.array(v)) for k, v in extra.iteritems())
+        arrays.update(params)
+        if pin:
+            # recognised by the writers of the runs that resume from here
+            arrays['pinned'] = numpy.array(True)
+        self._queue.put((name, arrays, rotate, pin, aliases))
+        if self.log is not None:
+            self.log.phase('checkpoint_save', time.time() - t0, detail=name)
+
+    def _write(self, name, arrays, rotate, pin, aliases):
+        t0 = time.time()
+        path = os.path.join(self.save_dir, name)
+        with open(path + '.tmp', 'wb') as f:
+            if self.compress:
+                numpy.savez_compressed(f, **arrays)
+            else:
+                numpy.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+        for alias in aliases:
+            alias = os.path.join(self.save_dir, alias)
+            if os.path.exists(alias + '.tmp'):
+                os.remove(alias + '.tmp')
+            try:
+                os.link(path, alias + '.tmp')
+            except OSError:
+                # no hard links on this file system
+                shutil.copyfile(path, alias + '.tmp')
+            os.rename(alias + '.tmp', alias)
+        if pin:
+            self.pinned.add(name)
+        if rotate:
+            if name in self.rotating:
+                self.rotating.remove(name)
+            self.rotating.append(name)
+            self._retain()
+        print 'checkpoint %s written in %.2f sec' % (name, time.time() - t0)
+        if self.log is not None:
+            self.log.phase('checkpoint_write', time.time() - t0, detail=name)
+
+    def _find_rotating(self, pattern):
+        found = []
+        for name in os.listdir(self.save_dir):
+            m = re.match(pattern, name)
+            if m is not None:
+                found.append((int(m.group(1)), name))
+        for _, name in sorted(found):
+            self.rotating.append(name)
+            with numpy.load(os.path.join(self.save_dir, name)) as archive:
+                if 'pinned' in archive.files:
+                    self.pinned.add(name)
+
+    def _retain(self):
+        if self.keep_last <= 0:
+            return
+        unpinned = [name for name in self.rotating if name not in self.pinned]
+        for name in unpinned[:-self.keep_last]:
+            os.remove(os.path.join(self.save_dir, name))
+            self.rotating.remove(name)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                if self._error is None:
+                    self._write(*job)
+            except Exception:
+                # re-raised in the training thread
+                self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error[0], error[1], error[2]
+
+    def wait(self):
+        # block until everything queued so far is on disk
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._check()
+
+
+def save_resume(writer, tparams, optimizer_state, trng, loop_state):
+    '''
+    loop_state: dict of the counters of the training loop (uidx, eidx,
+    minibatches done in the epoch, bad_counter, history_errs, ...).
+    '''
+    arrays = utils.unzip(tparams)
+    for v in optimizer_state:
+        arrays['optimizer.' + v.name] = v.get_value()
+    # MRG streams keep one shared state per random op in the graph
+    loop_state = dict(loop_state,
+                      trng_rstate=trng.rstate,
+                      trng_streams=[su[0].get_value() for su in trng.state_updates],
+                      numpy_rng=numpy.random.get_state())
+    # pickled into bytes, object arrays need allow_pickle on newer numpy
+    writer.save(RESUME_FILE, arrays, loop_state=numpy.frombuffer(
+        pkl.dumps(loop_state, pkl.HIGHEST_PROTOCOL), dtype='uint8'))
+
+
+def load_resume(path, tparams, optimizer_state, trng):
+    # restores the parameters, optimizer and random streams in place,
+    # returns the loop_state given to save_resume
+    archive = numpy.load(path)
+    for k, v in tparams.iteritems():
+        v.set_value(archive[k])
+    for v in optimizer_state:
+        v.set_value(archive['optimizer.' + v.name])
+    loop_state = pkl.loads(archive['loop_state'].tostring())
+    streams = loop_state.pop('trng_streams')
+    assert len(streams) == len(trng.state_updates), \
+        'the graph draws from a different number of random streams'
+    for su, value in zip(trng.state_updates, streams):
+        su[0].set_value(value)
+    trng.rstate = loop_state.pop('trng_rstate')
+    numpy.random.set_state(loop_state.pop('numpy_rng'))
+    return loop_state
@@ -5,6 +5,8 @@ RAB_DATASET_BASE_PATH = '/mnt/lustre/panyinxu/data/msvd/youtube2text_iccv15/'
 RAB_FEATURE_BASE_PATH = '/mnt/lustre/panyinxu/data/msvd/npy3/'
 # the dir where all the experiment data is dumped.
 RAB_EXP_PATH = './results/hLSTMat/'
+# the dir for derived data (caption index, ...) that can be rebuilt at any time
+RAB_CACHE_PATH = './results/cache/'
 
 config = DD({
     'model': 'attention',
@@ -16,6 +18,7 @@ config = DD({
         'save_model_dir': RAB_EXP_PATH + 'save_dir/',
         'from_dir': '',
         'dataset': 'youtube2text',
+        'dataset_manifest': None,  # dir written by streaming_dataset.py, None reads RAB_DATASET_BASE_PATH
         'video_feature': 'googlenet',
         'dim_word': 512,  # 468, # 474
         'ctx_dim': -1,  # auto set
@@ -41,7 +44,7 @@ config = DD({
         # in the unit of minibatches
         'dispFreq': 10,
         'validFreq': 2000,
-        'saveFreq': -1,  # this is disabled, now use sampleFreq instead
+        'saveFreq': -1,  # resume.npz every saveFreq updates, -1 only at validation
         'sampleFreq': 100,
         # blue, meteor, or both
         'metric': 'everything',  # set to perplexity on DVS
@@ -50,6 +53,50 @@ config = DD({
         'T': 28,
         'wh': 49,
         'OutOf': None,  # used to be 240, for motionfeature use 26
+        'feature_store': None,  # dir written by feature_store.py, None reads <vid>.npy
+        'feature_cache_mb': 0,  # LRU budget for <vid>.npy features, unused with feature_store
+        # minibatches assembled ahead, 0 is synchronous. Each holds a
+        # batch_size x K x ctx_dim float32 buffer (180 MB for 16 x 1372 x 2048),
+        # depth + 2 of them; past data_engine.MAX_BUFFER_MB the depth is cut
+        # with a warning
+        'prefetch_depth': 4,
+        'prefetch_workers': 2,
+        'n_buckets': 10,  # caption length buckets for shuffling, 0 keeps the fixed order
+        # workers sharing the training set and the decoding, all with the
+        # same save_model_dir; each one reads the shard of its rank
+        'rank': 0,
+        'world_size': 1,
+        # set by parallel.py: prefix of the shared memory files the workers
+        # average their gradients through, None trains each worker alone
+        'grad_sync': None,
+        # return probs, attention and all grads from every update to find NaNs
+        'grad_diagnostics': False,
+        # updates on the mean gradient of accum_steps minibatches of
+        # batch_size, for an effective batch that does not fit in memory
+        'accum_steps': 1,
+        # checkpoints are written in the background; model_<uidx>.npz of
+        # the last keep_checkpoints validations are kept, 0 keeps them all
+        'checkpoint_compress': False,
+        'keep_checkpoints': 3,
+        # per-update throughput and phase timings in save_model_dir/train_log.jsonl,
+        # 'csv' for train_log_<kind>.csv, None for none; compare runs with
+        # python training_log.py run_dir [run_dir ...]
+        'train_log': 'jsonl',
+        # Theano op-level profiling of the compiled functions: time and memory
+        # tables in save_model_dir/profile_<function>.txt, the profile_top_n
+        # slowest ops printed at every validation. The memory tables need
+        # Theano's Python VM, profile_memory=False times the C VM without them
+        'profile': False,
+        'profile_memory': True,
+        'profile_top_n': 20,
+        # directory of compiled functions kept across runs (function_cache.py),
+        # a restart with the same architecture skips the compilation; None for none
+        'function_cache': None,
+        # go on from save_model_dir/resume.npz if there is one, exactly where it stopped
+        'resume': False,
+        # validate parameter snapshots in another process (on CPU) while
+        # training goes on, early stopping acts on the results when they arrive
+        'async_valid': False,
         'verbose': True,
         'debug': False,
     }),
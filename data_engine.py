@@ -1,24 +1,39 @@
+import array
 import cPickle as pkl
 import gzip
+import hashlib
 import os, socket, shutil
 import sys, re
 import time
+import threading
 from collections import OrderedDict
 import numpy
 # import tables
 import theano
 import utils
 import config
+from feature_store import FeatureStore, FeatureCache, FrameManifest, decode_features
 
 from multiprocessing import Process, Queue, Manager
 
 hostname = socket.gethostname()
 
+# ctx masks memoized for videos outside a packed store, (K,) float32 each
+MAX_MEMO_MASKS = 100000
+# BatchBuffers rings are cut to a shallower prefetch depth to fit in this,
+# see fit_ring. The default batch_size=16, prefetch_depth=4 on 1372 x 2048
+# contexts takes 6 x 180 MB
+MAX_BUFFER_MB = 4096
+# features of the valid and test videos kept in memory across validations,
+# in the encoding of the packed store if there is one
+MAX_EVAL_CONTEXTS_MB = 4096
+
 
 class Movie2Caption(object):
     def __init__(self, model_type, signature, video_feature,
                  mb_size_train, mb_size_test, maxlen, n_words,
-                 n_frames=None, outof=None
+                 n_frames=None, outof=None, feature_store=None,
+                 feature_cache_mb=0
                  ):
         self.signature = signature
         self.model_type = model_type
@@ -27,19 +42,47 @@ class Movie2Caption(object):
         self.n_words = n_words
         self.K = n_frames
         self.OutOf = outof
+        self.feature_store_path = feature_store
+        self.feature_cache = None
+        if feature_cache_mb > 0:
+            self.feature_cache = FeatureCache(feature_cache_mb * 2 ** 20)
 
         self.mb_size_train = mb_size_train
         self.mb_size_test = mb_size_test
         self.non_pickable = []
+        # loaded on first use
+        self._CAP = None
+        self.cap_index = None
+        # vidID -> ctx mask, for videos not in a packed store, least
+        # recently used first; the prefetch workers share it
+        self.ctx_masks = OrderedDict()
+        self._mask_lock = threading.Lock()
+        # whichset -> EvalContexts, see get_eval_contexts
+        self.eval_contexts = {}
+        # whichset -> perplexity.EvalSet
+        self.eval_sets = {}
+        self._index_lock = threading.RLock()
 
         self.load_data()
 
     def _filter_googlenet(self, vidID):
-        feat = numpy.load(os.path.join(self.FEAT_ROOT, vidID + '.npy'))
-        # feat = self.FEAT[vidID]
-        feat = self.get_sub_frames(feat)
+        if self.feature_store is not None:
+            # already subsampled, a view into the packed memory map
+            return self.feature_store[vidID]
+        if self.feature_cache is not None:
+            feat = self.feature_cache.get(vidID)
+            if feat is not None:
+                return feat
+        feat = self.read_sub_frames(vidID)
+        if self.feature_cache is not None:
+            self.feature_cache.put(vidID, feat)
         return feat
 
+    def read_sub_frames(self, vidID):
+        # only the frames kept by get_sub_frames are read from the file
+        feat = self.get_sub_frames(self.frame_manifest.open(vidID))
+        return numpy.asarray(feat)
+
     def get_video_features(self, vidID):
         if self.video_feature == 'googlenet':
             y = self._filter_googlenet(vidID)
@@ -61,8 +104,7 @@ class Movie2Caption(object):
         # chunk frames into 'how_many' segments and use the first frame
         # from each segment
         n_frames = len(frames)
-        splits = numpy.array_split(range(n_frames), self.K)
-        idx_taken = [s[0] for s in splits]
+        idx_taken = self.frame_manifest.frame_indices(n_frames, self.K)
         sub_frames = frames[idx_taken]
         return sub_frames
 
@@ -104,20 +146,44 @@ class Movie2Caption(object):
 
     def prepare_data_for_blue(self, whichset):
         # assume one-to-one mapping between ids and features
-        feats = []
-        feats_mask = []
-        if whichset == 'valid':
-            ids = self.valid_ids
-        elif whichset == 'test':
-            ids = self.test_ids
-        elif whichset == 'train':
-            ids = self.train_ids
-        for i, vidID in enumerate(ids):
+        return self.get_eval_contexts(whichset)
+
+    def get_eval_contexts(self, whichset):
+        '''
+        The (ctx, ctx_mask) of every video of whichset, in the order of
+        its ids, for the decoding and pred_probs of every validation.
+        valid and test are kept, with up to MAX_EVAL_CONTEXTS_MB of
+        features; train, scored once at the end, is read as it goes.
+        '''
+        if whichset == 'train':
+            return EvalContexts(self, self.train_ids, 0)
+        if whichset not in self.eval_contexts:
+            ids = {'valid': self.valid_ids, 'test': self.test_ids}[whichset]
+            self.eval_contexts[whichset] = EvalContexts(
+                self, ids, MAX_EVAL_CONTEXTS_MB * 2 ** 20)
+        return self.eval_contexts[whichset]
+
+    def get_video_mask(self, vidID, feat=None):
+        '''
+        ctx mask of one video: from the packed store, or computed from
+        feat, the features of the video the caller has just read (read
+        here if None), and memoized for the last MAX_MEMO_MASKS videos.
+        '''
+        if self.feature_store is not None and self.feature_store.masks is not None:
+            return self.feature_store.masks[self.feature_store.vid_index[vidID]]
+        with self._mask_lock:
+            mask = self.ctx_masks.pop(vidID, None)
+            if mask is not None:
+                self.ctx_masks[vidID] = mask
+                return mask
+        if feat is None:
             feat = self.get_video_features(vidID)
-            feats.append(feat)
-            feat_mask = self.get_ctx_mask(feat)
-            feats_mask.append(feat_mask)
-        return feats, feats_mask
+        mask = self.get_ctx_mask(feat)
+        with self._mask_lock:
+            self.ctx_masks[vidID] = mask
+            if len(self.ctx_masks) > MAX_MEMO_MASKS:
+                self.ctx_masks.popitem(last=False)
+        return mask
 
     def get_ctx_mask(self, ctx):
         if ctx.ndim == 3:
@@ -136,29 +202,139 @@ class Movie2Caption(object):
 
         return rval
 
-    def load_data(self):
-        print 'loading youtube2text %s features' % self.video_feature
-        dataset_path = config.RAB_DATASET_BASE_PATH
-        feature_path = config.RAB_FEATURE_BASE_PATH
+    def iter_captions(self):
+        # (vidID, captions) of every video, in storage order
+        CAP = self.CAP
+        for vidID in CAP.keys():
+            yield vidID, CAP[vidID]
+
+    def build_caption_index(self):
+        # every caption of train/valid/test encoded once, in one pass over
+        # the captions: the word ids of tags[i] are tokens[offsets[i]:offsets[i + 1]]
+        wanted = set(self.train + self.valid + self.test)
+        tags = []
+        tokens = array.array('i')
+        offsets = [0]
+        for vidID, caps in self.iter_captions():
+            for cap in caps:
+                tag = '%s_%s' % (vidID, cap['cap_id'])
+                if tag not in wanted:
+                    continue
+                words = [w for w in cap['tokenized'].split(' ') if w != '']
+                tokens.extend([self.worddict[w]
+                               if w in self.worddict and self.worddict[w] < self.n_words else 1
+                               for w in words])
+                tags.append(tag)
+                offsets.append(len(tokens))
+        assert len(tags) == len(wanted), '%d tags without caption' % (len(wanted) - len(tags))
+        return tags, numpy.asarray(offsets, dtype='int64'), numpy.asarray(tokens, dtype='int32')
+
+    @property
+    def CAP(self):
+        # vidID -> captions, read from the indexed copy of CAP.pkl one video
+        # at a time; only the first run ever unpickles CAP.pkl as a whole
+        if self._CAP is None:
+            with self._index_lock:
+                if self._CAP is None:
+                    self._CAP = self.load_indexed_captions()
+        return self._CAP
+
+    def load_indexed_captions(self):
+        source = self.dataset_path + 'CAP.pkl'
+        path = os.path.join(config.RAB_CACHE_PATH, 'CAP_%s' % self.signature)
+        source_mtime = os.path.getmtime(source)
+        if os.path.isfile(path + '.idx'):
+            CAP = utils.IndexedPickle(path)
+            if CAP.source_mtime == source_mtime:
+                return CAP
+        print 'indexing %s' % source
+        utils.create_dir_if_not_exist(config.RAB_CACHE_PATH)
+        utils.dump_indexed_pkl(utils.load_pkl(source), path, source_mtime)
+        return utils.IndexedPickle(path)
+
+    def require_caption_index(self):
+        if self.cap_index is None:
+            with self._index_lock:
+                if self.cap_index is None:
+                    self.load_caption_index()
+
+    def caption_source_files(self):
+        # the caption index is rebuilt when any of these changes
+        return [self.dataset_path + f for f in ['CAP.pkl', 'train.pkl', 'valid.pkl', 'test.pkl']] + \
+               [self.worddict_file]
+
+    def load_caption_index(self):
+        # one cache per set of sources, e.g. per dataset_manifest
+        sources = self.caption_source_files()
+        cache = os.path.join(config.RAB_CACHE_PATH, 'cap_index_%s_%d_%s.npz' % (
+            self.signature, self.n_words,
+            hashlib.sha1('\n'.join(os.path.abspath(f) for f in sources)).hexdigest()[:12]))
+        source_mtime = max(os.path.getmtime(f) for f in sources)
+        index = numpy.load(cache) if os.path.isfile(cache) else None
+        if index is not None and index['source_mtime'] == source_mtime:
+            print 'loading caption index from %s' % cache
+            tags = index['tags'].tolist()
+            offsets = index['offsets']
+            tokens = index['tokens']
+        else:
+            print 'building caption index'
+            tags, offsets, tokens = self.build_caption_index()
+            utils.create_dir_if_not_exist(config.RAB_CACHE_PATH)
+            numpy.savez(cache, tags=numpy.asarray(tags), offsets=offsets,
+                        tokens=tokens, source_mtime=source_mtime)
+        self.cap_offsets = offsets
+        self.cap_tokens = tokens
+        # set last, it marks the index as loaded
+        self.cap_index = dict((tag, i) for i, tag in enumerate(tags))
+
+    def get_caption(self, tag):
+        # int32 word ids of one caption, a view into self.cap_tokens
+        self.require_caption_index()
+        i = self.cap_index[tag]
+        return self.cap_tokens[self.cap_offsets[i]:self.cap_offsets[i + 1]]
+
+    def caption_lengths(self, tags):
+        self.require_caption_index()
+        i = numpy.asarray([self.cap_index[tag] for tag in tags], dtype='int64')
+        return self.cap_offsets[i + 1] - self.cap_offsets[i]
+
+    def load_splits(self):
+        dataset_path = self.dataset_path
         self.train = utils.load_pkl(dataset_path + 'train.pkl')
         self.valid = utils.load_pkl(dataset_path + 'valid.pkl')
         self.test = utils.load_pkl(dataset_path + 'test.pkl')
-        self.CAP = utils.load_pkl(dataset_path + 'CAP.pkl')
-        self.FEAT = utils.load_pkl(dataset_path + 'FEAT_key_vidID_value_features.pkl')
-        self.FEAT_ROOT = feature_path
         if self.signature == 'youtube2text':
             self.train_ids = ['vid%s' % i for i in range(1, 1201)]
             self.valid_ids = ['vid%s' % i for i in range(1201, 1301)]
             self.test_ids = ['vid%s' % i for i in range(1301, 1971)]
-            self.worddict = utils.load_pkl(dataset_path + 'worddict.pkl')
+            self.worddict_file = dataset_path + 'worddict.pkl'
         elif self.signature == 'msr-vtt':
             self.train_ids = ['video%s' % i for i in range(0, 6513)]
             self.valid_ids = ['video%s' % i for i in range(6513, 7010)]
             self.test_ids = ['video%s' % i for i in range(7010, 10000)]
-            self.worddict = utils.load_pkl(dataset_path + 'worddict_large.pkl')
+            self.worddict_file = dataset_path + 'worddict_large.pkl'
         else:
             raise NotImplementedError()
 
+    def load_data(self):
+        print 'loading youtube2text %s features' % self.video_feature
+        t0 = time.time()
+        dataset_path = config.RAB_DATASET_BASE_PATH
+        feature_path = config.RAB_FEATURE_BASE_PATH
+        self.dataset_path = dataset_path
+        self.load_splits()
+        # CAP and the caption index are loaded on first use
+        self.FEAT_ROOT = feature_path
+        self.frame_manifest = FrameManifest(feature_path, os.path.join(
+            config.RAB_CACHE_PATH, 'frames_%s.pkl' % self.signature))
+        self.feature_store = None
+        if self.feature_store_path:
+            print 'using packed features from %s' % self.feature_store_path
+            self.feature_store = FeatureStore(self.feature_store_path)
+            assert self.feature_store.K == self.K, \
+                'store packed with K=%d' % self.feature_store.K
+        self.worddict = utils.load_pkl(self.worddict_file)
+
         self.word_idict = dict()
         # wordict start with index 2
         for kk, vv in self.worddict.iteritems():
@@ -174,68 +350,153 @@ class Movie2Caption(object):
             self.ctx_dim = 2048
         else:
             raise NotImplementedError()
+        if self.feature_store is not None:
+            # the store may hold projected features
+            self.ctx_dim = self.feature_store.ctx_dim
         self.kf_train = utils.generate_minibatch_idx(
             len(self.train), self.mb_size_train)
         self.kf_valid = utils.generate_minibatch_idx(
             len(self.valid), self.mb_size_test)
         self.kf_test = utils.generate_minibatch_idx(
             len(self.test), self.mb_size_test)
-
-
-def prepare_data(engine, IDs):
+        print 'data loaded in %.2f sec' % (time.time() - t0)
+
+
+class EvalContexts(object):
+    def __init__(self, engine, ids, max_bytes):
+        '''
+        The features of the videos read first stay in memory up to
+        max_bytes, as rows of the packed store in its encoding (float16,
+        int8) or as the float32 frames of the other videos; the rest are
+        read again when indexed.
+        '''
+        self.engine = engine
+        self.ids = ids
+        self.max_bytes = max_bytes
+        self.resident = {}
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _read(self, vidID):
+        store = self.engine.feature_store
+        if store is not None:
+            return numpy.array(store.feats[store.vid_index[vidID]])
+        return self.engine.get_video_features(vidID)
+
+    def get(self, vidID):
+        feat = self.resident.get(vidID)
+        if feat is None:
+            feat = self._read(vidID)
+            if self.nbytes + feat.nbytes <= self.max_bytes:
+                self.resident[vidID] = feat
+                self.nbytes += feat.nbytes
+        store = self.engine.feature_store
+        if store is not None:
+            feat = decode_features(feat, store.encoding, store.scale)
+        # the mask from the features just read
+        return feat, self.engine.get_video_mask(vidID, feat)
+
+    def __getitem__(self, i):
+        return self.get(self.ids[i])
+
+
+class BatchBuffers(object):
+    '''
+    Ring of preallocated (x, x_mask, ctx, ctx_mask) buffers that
+    prepare_data fills in place. A minibatch returned from slot i stays
+    valid until slot i is filled again, n_slots minibatches later.
+    The ring takes n_slots * nbytes(...) bytes, mostly the
+    batch_size x K x ctx_dim float32 contexts: about 720 MB a slot for
+    64 x 1372 x 2048, see fit_ring.
+    '''
+    @staticmethod
+    def nbytes(batch_size, maxlen, K, ctx_dim):
+        # one slot
+        return maxlen * batch_size * (8 + 4) + batch_size * K * (ctx_dim + 1) * 4
+
+    def __init__(self, n_slots, batch_size, maxlen, K, ctx_dim):
+        self.slots = []
+        for i in range(n_slots):
+            self.slots.append((numpy.zeros((maxlen, batch_size), dtype='int64'),
+                               numpy.zeros((maxlen, batch_size), dtype='float32'),
+                               numpy.zeros((batch_size, K, ctx_dim), dtype='float32'),
+                               numpy.zeros((batch_size, K), dtype='float32')))
+
+    def __len__(self):
+        return len(self.slots)
+
+    def slot(self, i):
+        return self.slots[i % len(self.slots)]
+
+
+_ring_warned = set()
+
+
+def fit_ring(depth, slot_nbytes, what):
+    '''
+    Prefetch depth, at most depth, whose ring of depth + 2 slots of
+    slot_nbytes fits in MAX_BUFFER_MB, or None if even depth 1 does not
+    and every minibatch should get its own arrays. Warns once per what
+    when depth is cut.
+    '''
+    limit = MAX_BUFFER_MB * 2 ** 20
+    fit = depth
+    while fit > 1 and (fit + 2) * slot_nbytes > limit:
+        fit -= 1
+    if (fit + 2) * slot_nbytes > limit:
+        fit = None
+    if fit != depth and what not in _ring_warned:
+        _ring_warned.add(what)
+        print 'WARNING: %s needs %.0f MB of minibatch buffers for prefetch depth %d, ' \
+            'over MAX_BUFFER_MB=%d: %s' % (
+                what, (depth + 2) * slot_nbytes / 2. ** 20, depth, MAX_BUFFER_MB,
+                'allocating per minibatch' if fit is None else 'using depth %d' % fit)
+    return fit
+
+
+def prepare_data(engine, IDs, buffers=None, slot=0):
     seqs = []
-    feat_list = []
-
-    def get_words(vidID, capID):
-        caps = engine.CAP[vidID]
-        rval = None
-        for cap in caps:
-            if str(cap['cap_id']) == capID:
-                rval = cap['tokenized'].split(' ')
-                rval = [w for w in rval if w != '']
-                break
-        assert rval is not None
-        return rval
+    vidIDs = []
 
     for i, ID in enumerate(IDs):
         # print 'processed %d/%d caps'%(i,len(IDs))
-        # load GNet feature
-        vidID, capID = ID.split('_')
-        feat = engine.get_video_features(vidID)
-        feat_list.append(feat)
-        words = get_words(vidID, capID)
-        seqs.append([engine.worddict[w]
-                     if w in engine.worddict and engine.worddict[w] < engine.n_words else 1 for w in words])
+        # word ids, already encoded by load_caption_index
+        s = engine.get_caption(ID)
+        # sequences that have length >= maxlen will be thrown away
+        if engine.maxlen != None and len(s) >= engine.maxlen:
+            continue
+        seqs.append(s)
+        vidIDs.append(ID.split('_')[0])
+    if len(seqs) < 1:
+        return None, None, None, None
 
     lengths = [len(s) for s in seqs]
-    if engine.maxlen != None:
-        new_seqs = []
-        new_feat_list = []
-        new_lengths = []
-        new_caps = []
-        for l, s, y, c in zip(lengths, seqs, feat_list, IDs):
-            # sequences that have length >= maxlen will be thrown away 
-            if l < engine.maxlen:
-                new_seqs.append(s)
-                new_feat_list.append(y)
-                new_lengths.append(l)
-                new_caps.append(c)
-        lengths = new_lengths
-        feat_list = new_feat_list
-        seqs = new_seqs
-        if len(lengths) < 1:
-            return None, None, None, None
-
-    y = numpy.asarray(feat_list)
-    y_mask = engine.get_ctx_mask(y)
     n_samples = len(seqs)
     maxlen = numpy.max(lengths) + 1
 
-    x = numpy.zeros((maxlen, n_samples)).astype('int64')
-    x_mask = numpy.zeros((maxlen, n_samples)).astype('float32')
+    if buffers is None:
+        x = numpy.zeros((maxlen, n_samples)).astype('int64')
+        x_mask = numpy.zeros((maxlen, n_samples)).astype('float32')
+        y = numpy.zeros((n_samples, engine.K, engine.ctx_dim), dtype='float32')
+        y_mask = numpy.zeros((n_samples, engine.K), dtype='float32')
+    else:
+        # views into the next ring slot, the padding is cleared in place
+        x, x_mask, y, y_mask = buffers.slot(slot)
+        x = x[:maxlen, :n_samples]
+        x_mask = x_mask[:maxlen, :n_samples]
+        y = y[:n_samples]
+        y_mask = y_mask[:n_samples]
+        x[:] = 0
+        x_mask[:] = 0.
     for idx, s in enumerate(seqs):
         x[:lengths[idx], idx] = s
         x_mask[:lengths[idx] + 1, idx] = 1.
+        # load GNet feature straight into the batch
+        y[idx] = engine.get_video_features(vidIDs[idx])
+        # from the features just read, a video outside the store is read once
+        y_mask[idx] = engine.get_video_mask(vidIDs[idx], y[idx])
 
     return x, x_mask, y, y_mask
 
@@ -2,13 +2,14 @@ import time
 
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
-import data_engine
 import metrics
 from config import config
 from model_hLSTMat.model import Model
 from model_hLSTMat.cmb_model import CMBModel
 from model_hLSTMat.non_local_model import NonLocalModel
 import utils
+from function_cache import load_sampler
+from streaming_dataset import load_engine
 import os
 
 import theano
@@ -18,21 +19,13 @@ import cPickle as pickle
 
 
 def test(model_options_file='model_options.pkl',
-         model_file='model_best_so_far.npz'):
+         model_file='model_best_so_far.npz', function_cache=None):
     from_dir = 'model_files/'
     print 'preparing reload'
     model_options = utils.load_pkl(from_dir + model_options_file)
 
     print 'Loading data'
-    engine = data_engine.Movie2Caption('attention',
-                                       model_options['dataset'],
-                                       model_options['video_feature'],
-                                       model_options['batch_size'],
-                                       model_options['valid_batch_size'],
-                                       model_options['maxlen'],
-                                       model_options['n_words'],
-                                       model_options['K'],
-                                       model_options['OutOf'])
+    engine = load_engine(model_options)
 
     print 'init params'
     t0 = time.time()
@@ -49,10 +42,7 @@ def test(model_options_file='model_options.pkl',
     print tparams.keys
 
     print 'buliding sampler'
-    use_noise = theano.shared(numpy.float32(0.))
-    use_noise.set_value(0.)
-    trng = RandomStreams(1234)
-    f_init, f_next = model.build_sampler(tparams, model_options, use_noise, trng)
+    f_init, f_next = load_sampler(function_cache, model, tparams, model_options)
 
     print 'start test...'
     blue_t0 = time.time()
@@ -0,0 +1,336 @@
+'''
+Packed feature store: the K subsampled frames of every video are written
+once into a single contiguous (n_videos, K, ctx_dim) array which is then
+opened as a read-only memory map, so fetching a video is a zero-copy view
+instead of a numpy.load per sample. Stores can also be packed as float16
+or per-channel int8 and are upcast to float32 when a video is fetched,
+and the frames can be projected to a smaller ctx_dim with a PCA fitted on
+the training videos.
+Without a packed store, FrameManifest reads only the K selected frames of
+the raw <vid>.npy files and FeatureCache keeps recently used videos in
+memory.
+'''
+import argparse
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy
+
+import utils
+
+FEATS_FILE = 'feats.npy'
+MASKS_FILE = 'masks.npy'
+META_FILE = 'meta.pkl'
+ENCODINGS = ['float32', 'float16', 'int8']
+
+
+def encode_features(feat, encoding, scale=None):
+    if encoding == 'float32':
+        return feat
+    elif encoding == 'float16':
+        return feat.astype('float16')
+    elif encoding == 'int8':
+        # symmetric, so zero padded frames stay exactly zero for get_ctx_mask
+        return numpy.clip(numpy.round(feat / scale), -127, 127).astype('int8')
+    else:
+        raise NotImplementedError(encoding)
+
+
+def decode_features(feat, encoding, scale=None):
+    if encoding == 'float32':
+        return feat
+    elif encoding == 'float16':
+        return feat.astype('float32')
+    elif encoding == 'int8':
+        return feat.astype('float32') * scale
+    else:
+        raise NotImplementedError(encoding)
+
+
+class FeatureStore(object):
+    def __init__(self, root):
+        self.root = root
+        meta = utils.load_pkl(os.path.join(root, META_FILE))
+        self.K = meta['K']
+        self.ctx_dim = meta['ctx_dim']
+        # vidID -> row in feats
+        self.vid_index = meta['vid_index']
+        self.encoding = meta.get('encoding', 'float32')
+        # per-channel step of the int8 encoding
+        self.scale = meta.get('scale')
+        # PCA the frames were projected with, if any
+        self.projection = meta.get('projection')
+        self.feats = numpy.load(os.path.join(root, FEATS_FILE), mmap_mode='r')
+        assert self.feats.shape == (len(self.vid_index), self.K, self.ctx_dim)
+        # (n_videos, K) ctx masks computed when packing, None for old stores
+        self.masks = None
+        if os.path.isfile(os.path.join(root, MASKS_FILE)):
+            self.masks = numpy.load(os.path.join(root, MASKS_FILE))
+
+    def __len__(self):
+        return len(self.vid_index)
+
+    def __contains__(self, vidID):
+        return vidID in self.vid_index
+
+    def __getitem__(self, vidID):
+        # (K, ctx_dim) float32: a view into the memory map, nothing is read
+        # until used, or the upcast copy of a float16/int8 store
+        return decode_features(self.feats[self.vid_index[vidID]],
+                               self.encoding, self.scale)
+
+    def reconstruct(self, vidID):
+        # frames in the original feature space, to compare stores
+        feat = self[vidID]
+        if self.projection is None:
+            return feat
+        mask = self.masks[self.vid_index[vidID]]
+        rval = feat.dot(self.projection['components'].T) + self.projection['mean']
+        rval[mask == 0] = 0.
+        return rval
+
+
+class FrameManifest(object):
+    '''
+    Shape, dtype and data offset of every raw <vid>.npy under feat_root.
+    Videos are opened as memory maps straight from these, so subsampling
+    reads only the selected frames and changing K or T needs neither
+    re-extraction nor re-packing. Videos missing from the manifest file
+    have their npy header read on first use.
+    '''
+    def __init__(self, feat_root, path):
+        self.feat_root = feat_root
+        self.path = path
+        self.entries = {}
+        if os.path.isfile(path):
+            manifest = utils.load_pkl(path)
+            if manifest['feat_root'] == feat_root:
+                self.entries = manifest['entries']
+        # (n_frames, K) -> indices of the frames kept
+        self._indices = {}
+
+    def __contains__(self, vidID):
+        return vidID in self.entries
+
+    def _read_header(self, vidID):
+        f = open(os.path.join(self.feat_root, vidID + '.npy'), 'rb')
+        try:
+            version = numpy.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(f)
+            assert not fortran_order
+            return shape, dtype.str, f.tell()
+        finally:
+            f.close()
+
+    def get(self, vidID):
+        entry = self.entries.get(vidID)
+        if entry is None:
+            entry = self._read_header(vidID)
+            self.entries[vidID] = entry
+        return entry
+
+    def n_frames(self, vidID):
+        return self.get(vidID)[0][0]
+
+    def open(self, vidID):
+        # memory map of the whole video, nothing is read until indexed
+        shape, dtype, offset = self.get(vidID)
+        return numpy.memmap(os.path.join(self.feat_root, vidID + '.npy'),
+                            dtype=dtype, mode='r', offset=offset, shape=shape)
+
+    def frame_indices(self, n_frames, K):
+        # the first frame of each of K equal chunks, as
+        # numpy.array_split(range(n_frames), K)
+        key = (n_frames, K)
+        idx = self._indices.get(key)
+        if idx is None:
+            q, r = divmod(n_frames, K)
+            idx = numpy.arange(K) * q + numpy.minimum(numpy.arange(K), r)
+            self._indices[key] = idx
+        return idx
+
+    def save(self):
+        utils.dump_pkl({'feat_root': self.feat_root, 'entries': self.entries},
+                       self.path)
+
+
+def build_frame_manifest(engine, vidIDs):
+    t0 = time.time()
+    for vidID in vidIDs:
+        engine.frame_manifest.get(vidID)
+    utils.create_dir_if_not_exist(os.path.dirname(engine.frame_manifest.path))
+    engine.frame_manifest.save()
+    print 'wrote manifest of %d videos to %s, %.1f sec' % (
+        len(vidIDs), engine.frame_manifest.path, time.time() - t0)
+
+
+class FeatureCache(object):
+    '''
+    LRU cache of subsampled video features bounded by a byte budget.
+    Thread-safe, so the prefetch workers of one process share it.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            # most recently used goes last
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if value.nbytes > self.max_bytes:
+            return
+        # cached arrays are handed out to every caller
+        value.setflags(write=False)
+        with self._lock:
+            if key in self._items:
+                self.n_bytes -= self._items.pop(key).nbytes
+            self._items[key] = value
+            self.n_bytes += value.nbytes
+            while self.n_bytes > self.max_bytes:
+                _, old = self._items.popitem(last=False)
+                self.n_bytes -= old.nbytes
+                self.evictions += 1
+
+    def stats(self):
+        total = max(self.hits + self.misses, 1)
+        return 'feature cache: %d videos, %.1f/%.1f MB, hits %d (%.1f%%), misses %d, evictions %d' % (
+            len(self._items), self.n_bytes / 2. ** 20, self.max_bytes / 2. ** 20,
+            self.hits, 100. * self.hits / total, self.misses, self.evictions)
+
+
+def fit_projection(engine, vidIDs, dim, n_fit=500, seed=1234):
+    # PCA on the frames (padding excluded) of a random subset of the videos
+    rng = numpy.random.RandomState(seed)
+    subset = rng.permutation(len(vidIDs))[:n_fit]
+    n = 0
+    s = 0.
+    ss = 0.
+    for i in subset:
+        feat = engine.read_sub_frames(vidIDs[i])
+        rows = feat[engine.get_ctx_mask(feat) > 0].astype('float64')
+        n += len(rows)
+        s += rows.sum(axis=0)
+        ss += rows.T.dot(rows)
+    mean = s / n
+    eigval, eigvec = numpy.linalg.eigh(ss / n - numpy.outer(mean, mean))
+    order = numpy.argsort(eigval)[::-1][:dim]
+    projection = {'mean': mean.astype('float32'),
+                  'components': eigvec[:, order].astype('float32'),
+                  'explained_variance': eigval[order].sum() / eigval.sum()}
+    print 'projection to %d dims keeps %.1f%% of the variance' % (
+        dim, 100. * projection['explained_variance'])
+    return projection
+
+
+def project_features(feat, mask, projection):
+    # padded frames stay zero so that the ctx mask still holds
+    rval = (feat - projection['mean']).dot(projection['components'])
+    rval[mask == 0] = 0.
+    return rval
+
+
+def read_packed_frames(engine, vidID, projection=None):
+    feat = engine.read_sub_frames(vidID)
+    mask = engine.get_ctx_mask(feat)
+    if projection is not None:
+        feat = project_features(feat, mask, projection)
+    return feat, mask
+
+
+def calibrate_int8(engine, vidIDs, projection=None, n_calib=200, seed=1234):
+    # per-channel max(abs) over a random subset of the videos
+    rng = numpy.random.RandomState(seed)
+    subset = rng.permutation(len(vidIDs))[:n_calib]
+    max_abs = None
+    for i in subset:
+        feat, _ = read_packed_frames(engine, vidIDs[i], projection)
+        feat = numpy.abs(feat).max(axis=0)
+        max_abs = feat if max_abs is None else numpy.maximum(max_abs, feat)
+    # values beyond the calibration range are clipped when encoding
+    max_abs[max_abs == 0] = 1.
+    return (max_abs / 127.).astype('float32')
+
+
+def pack_features(engine, vidIDs, out_dir, encoding='float32', projection=None):
+    # subsample every video with the engine's K/OutOf settings, optionally
+    # project it, and write them all into one memory-mapped file
+    assert encoding in ENCODINGS
+    utils.create_dir_if_not_exist(out_dir)
+    scale = None
+    if encoding == 'int8':
+        scale = calibrate_int8(engine, vidIDs, projection)
+    feats = None
+    masks = None
+    vid_index = {}
+    t0 = time.time()
+    for i, vidID in enumerate(vidIDs):
+        feat, mask = read_packed_frames(engine, vidID, projection)
+        if feats is None:
+            # the shape of the first video fixes the store layout
+            feats = numpy.lib.format.open_memmap(
+                os.path.join(out_dir, FEATS_FILE), mode='w+',
+                dtype=encoding, shape=(len(vidIDs),) + feat.shape)
+            masks = numpy.zeros((len(vidIDs), feat.shape[0]), dtype='float32')
+        feats[i] = encode_features(feat, encoding, scale)
+        masks[i] = mask
+        vid_index[vidID] = i
+        if i % 100 == 0:
+            print 'packed %d/%d videos, %.1f sec' % (i, len(vidIDs), time.time() - t0)
+    feats.flush()
+    numpy.save(os.path.join(out_dir, MASKS_FILE), masks)
+    meta = {'K': feats.shape[1], 'ctx_dim': feats.shape[2],
+            'vid_index': vid_index, 'encoding': encoding, 'scale': scale,
+            'projection': projection}
+    # meta goes last, a store without it is incomplete
+    utils.dump_pkl(meta, os.path.join(out_dir, META_FILE))
+    print 'packed %d videos into %s, %.1f sec' % (
+        len(vidIDs), out_dir, time.time() - t0)
+    return FeatureStore(out_dir)
+
+
+def main():
+    import data_engine
+    parser = argparse.ArgumentParser(description='pack video features')
+    parser.add_argument('out_dir', nargs='?', default=None,
+                        help='pack into this dir, without it only write the frame manifest')
+    parser.add_argument('--dataset', default='youtube2text')
+    parser.add_argument('--K', type=int, default=28 * 7 * 7)
+    parser.add_argument('--OutOf', type=int, default=None)
+    parser.add_argument('--encoding', default='float32', choices=ENCODINGS)
+    parser.add_argument('--dim', type=int, default=0,
+                        help='project to this ctx_dim with a PCA fitted on the train videos')
+    args = parser.parse_args()
+    engine = data_engine.Movie2Caption('attention', args.dataset, 'googlenet',
+                                       1, 1, None, 20000,
+                                       n_frames=args.K, outof=args.OutOf)
+    vidIDs = engine.train_ids + engine.valid_ids + engine.test_ids
+    if args.out_dir is None:
+        build_frame_manifest(engine, vidIDs)
+    else:
+        projection = None
+        if args.dim > 0:
+            projection = fit_projection(engine, engine.train_ids, args.dim)
+        pack_features(engine, vidIDs, args.out_dir, encoding=args.encoding,
+                      projection=projection)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+'''
+On-disk cache of compiled Theano functions: a bundle of functions and the
+shared variables they use (parameters, optimizer state, random streams)
+is pickled once under a key made of the model class, the model options
+that change the graph, the sources of the model and of the functions, and
+the Theano version and flags. A restart, an evaluation job or a worker of
+a sweep with the same architecture loads the bundle instead of compiling
+it, then sets the parameters to its own with utils.zipp.
+
+The pickles hold the values of the shared variables at the time they
+were written, about as many copies of the parameters as the bundle has
+state. Unpickling still links the functions, but skips the graph
+optimizations and reuses Theano's compiled C modules.
+'''
+import cPickle as pkl
+import glob
+import hashlib
+import os
+import sys
+import time
+
+import numpy
+import theano
+from theano.sandbox.rng_mrg import MRG_RandomStreams
+
+import utils
+
+# options of train() that never reach the graph, a sweep over them shares
+# the cache
+RUN_OPTIONS = ['random_seed', 'patience', 'max_epochs', 'dispFreq', 'lrate',
+               'valid_batch_size', 'save_model_dir', 'validFreq', 'saveFreq',
+               'sampleFreq', 'metric', 'reload_', 'from_dir', 'verbose', 'debug',
+               'feature_store', 'feature_cache_mb', 'dataset_manifest',
+               'prefetch_depth', 'prefetch_workers', 'n_buckets', 'rank',
+               'world_size', 'grad_sync', 'checkpoint_compress',
+               'keep_checkpoints', 'resume', 'async_valid', 'train_log',
+               'profile_memory', 'profile_top_n', 'function_cache']
+
+
+def _source(path):
+    # the .py of a .pyc
+    if path.endswith('.pyc'):
+        path = path[:-1]
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class FunctionCache(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, name, model, options, sources=()):
+        '''
+        sources: files of the code building the bundle besides the model
+        package, e.g. optimizers.py.
+        '''
+        h = hashlib.sha1()
+        h.update('%s %s.%s\n' % (name, type(model).__module__, type(model).__name__))
+        for k in sorted(options):
+            v = options[k]
+            if k in RUN_OPTIONS or \
+                    isinstance(v, (numpy.random.RandomState, MRG_RandomStreams)):
+                continue
+            h.update('%s=%r\n' % (k, v))
+        model_dir = os.path.dirname(os.path.abspath(sys.modules[type(model).__module__].__file__))
+        for path in sorted(glob.glob(os.path.join(model_dir, '*.py'))) + list(sources):
+            h.update(_source(path))
+        h.update('theano %s %s %s %s %s\n' % (
+            theano.__version__, theano.config.floatX, theano.config.device,
+            theano.config.mode, theano.config.optimizer))
+        return h.hexdigest()
+
+    def path(self, name, key):
+        return os.path.join(self.cache_dir, '%s_%s.pkl' % (name, key))
+
+    def load(self, name, key):
+        path = self.path(name, key)
+        if not os.path.isfile(path):
+            return None
+        t0 = time.time()
+        try:
+            with open(path, 'rb') as f:
+                bundle = pkl.load(f)
+        except Exception as e:
+            # written by another version of a dependency, compiled again
+            print 'could not load %s: %r' % (path, e)
+            return None
+        print 'loaded compiled %s functions from %s in %.2f sec' % (
+            name, path, time.time() - t0)
+        return bundle
+
+    def save(self, name, key, bundle):
+        # renamed into place, workers of a sweep may write the same key
+        path = self.path(name, key)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        limit = sys.getrecursionlimit()
+        # deep graphs of scans
+        sys.setrecursionlimit(max(limit, 50000))
+        try:
+            with open(tmp, 'wb') as f:
+                pkl.dump(bundle, f, pkl.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+        finally:
+            sys.setrecursionlimit(limit)
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+        print 'saved compiled %s functions to %s' % (name, path)
+
+
+def load_or_build(cache_dir, name, model, options, build, sources=()):
+    '''
+    The bundle (a dict) returned by build(), from cache_dir when it has
+    been built before with the same key. No caching if cache_dir is None.
+    '''
+    if cache_dir is None:
+        return build()
+    cache = FunctionCache(cache_dir)
+    key = cache.key(name, model, options, sources)
+    bundle = cache.load(name, key)
+    if bundle is None:
+        bundle = build()
+        cache.save(name, key, bundle)
+    return bundle
+
+
+def load_sampler(cache_dir, model, tparams, options):
+    '''
+    (f_init, f_next) of model.build_sampler on tparams, through the cache
+    as load_or_build; the functions of evaluation.py and generator.py.
+    '''
+    def build():
+        use_noise = theano.shared(numpy.float32(0.))
+        trng = MRG_RandomStreams(1234)
+        f_init, f_next = model.build_sampler(tparams, options, use_noise, trng)
+        return {'tparams': tparams, 'f_init': f_init, 'f_next': f_next}
+    bundle = load_or_build(cache_dir, 'sampler', model, options, build,
+                           sources=[__file__, utils.__file__])
+    utils.zipp(utils.unzip(tparams), bundle['tparams'])
+    return bundle['f_init'], bundle['f_next']
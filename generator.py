@@ -2,10 +2,12 @@ import time
 
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
-import data_engine
 from config import config
 from model_hLSTMat.model import Model
 import utils
+from function_cache import load_sampler
+from feature_store import project_features
+from streaming_dataset import load_engine
 import os
 
 import theano
@@ -13,25 +15,25 @@ import numpy
 
 
 def generate(model_options_file='model_options.pkl',
-         model_file='model_best_so_far.npz'):
+         model_file='model_best_so_far.npz', function_cache=None):
     from_dir = 'model_files/'
     print 'preparing reload'
     model_options = utils.load_pkl(from_dir+model_options_file)
 
     print 'Loading data'
-    engine = data_engine.Movie2Caption('attention',
-                                       model_options['dataset'],
-                                       model_options['video_feature'],
-                                       model_options['batch_size'],
-                                       model_options['valid_batch_size'],
-                                       model_options['maxlen'],
-                                       model_options['n_words'],
-                                       model_options['K'],
-                                       model_options['OutOf'])
+    engine = load_engine(model_options)
 
     feat = numpy.load('datas/vid1715.npy')
     ctx = engine.get_sub_frames(feat)
-    ctx_mask = engine.get_ctx_mask(ctx)
+    # over all the channels, engine.ctx_dim is that of the store
+    ctx_mask = (ctx.sum(axis=-1) != 0).astype('float32')
+    store = engine.feature_store
+    if store is not None and store.projection is not None:
+        # the model was trained on the projected frames of the store
+        ctx = project_features(ctx, ctx_mask, store.projection)
+    assert ctx.shape[-1] == model_options['ctx_dim'], \
+        'model trained on %d-d features, got %d-d ones' % (
+            model_options['ctx_dim'], ctx.shape[-1])
 
     print 'init params'
     t0 = time.time()
@@ -46,10 +48,7 @@ def generate(model_options_file='model_options.pkl',
     print tparams.keys
 
     print 'buliding sampler'
-    use_noise = theano.shared(numpy.float32(0.))
-    use_noise.set_value(0.)
-    trng = RandomStreams(1234)
-    f_init, f_next = model.build_sampler(tparams, model_options, use_noise, trng)
+    f_init, f_next = load_sampler(function_cache, model, tparams, model_options)
 
     print 'start generate...'
     g_t0 = time.time()
@@ -11,6 +11,8 @@ import train_model
 import data_engine
 from cocoeval import COCOScorer
 import utils
+from parallel import Workers
+from samplers import shard_ids
 
 MAXLEN = 50
 
@@ -71,6 +73,54 @@ def gen_model(queue, rqueue, pid, model, options, beam,
     return
 
 
+def validate_model(queue, rqueue, model, options, engine, save_dir,
+                   shared_params, rank=0, world_size=1):
+    '''
+    Validation worker: every request on queue is the uidx of the snapshot
+    last written to shared_params by update_params. The valid/test costs
+    and caption scores of that snapshot are computed on CPU while the
+    training process goes on, and put on rqueue.
+    '''
+    import theano
+    from theano import tensor
+
+    mode = theano.compile.get_default_mode().excluding('gpu')
+    params = model.init_params(options)
+    for kk in params:
+        # theano.tensor._shared only takes ndarray
+        params[kk] = numpy.asarray(params[kk])
+    tparams = utils.init_tparams(params, force_cpu=True)
+    trng, use_noise, x, mask, ctx, mask_ctx, cost, _ = \
+        model.build_model(tparams, options)
+    f_log_probs = theano.function([x, mask, ctx, mask_ctx], -cost, mode=mode,
+                                  on_unused_input='ignore')
+    f_init, f_next = model.build_sampler(tparams, options, use_noise, trng, mode=mode)
+    use_noise.set_value(0.)
+    workers = None
+    if options.get('grad_sync'):
+        # independent workers (no grad_sync) validate on their own
+        workers = Workers(save_dir, options['grad_sync'], rank, world_size)
+
+    while True:
+        uidx = queue.get()
+        if uidx is None:
+            break
+        t0 = time.time()
+        for kk in tparams:
+            tparams[kk].set_value(numpy.asarray(shared_params[kk]))
+        (valid_err, valid_perp), (test_err, test_perp) = model.pred_probs(
+            engine, ['valid', 'test'], f_log_probs, verbose=False,
+            workers=workers, key=uidx)
+        scores = compute_score(
+            model_type='attention', model_archive=None, options=options,
+            engine=engine, save_dir=save_dir, beam=5, n_process=1,
+            whichset='both', on_cpu=False, metric=options['metric'],
+            one_time=True, f_init=f_init, f_next=f_next, model=model,
+            rank=rank, world_size=world_size, uidx=uidx)
+        rqueue.put((uidx, valid_err, valid_perp, test_err, test_perp, scores,
+                    time.time() - t0))
+
+
 manager = Manager()
 
 
@@ -110,11 +160,25 @@ def score_with_cocoeval(samples_valid, samples_test, engine):
     return valid_score, test_score, scorer.imgToEval
 
 
+def gather_samples(workers, uidx, whichset, share, samples, n_samples):
+    '''
+    Exchange the captions decoded by the workers (a parallel.Workers) and
+    return all n_samples of them in order.
+    '''
+    rval = [None] * n_samples
+    for idx, caps in workers.all_gather('samples_%d_%s' % (uidx, whichset),
+                                        (share, samples)):
+        for i, cap in zip(idx, caps):
+            rval[i] = cap
+    assert None not in rval, 'workers decoded different sets'
+    return rval
+
+
 def generate_sample_gpu_single_process(
         model_type, model_archive, options, engine, model,
         f_init, f_next,
         save_dir='./samples', beam=5,
-        whichset='both'):
+        whichset='both', rank=0, world_size=1, uidx=0):
     def _seqs2words(caps):
         capsw = []
         for cc in caps:
@@ -127,11 +191,21 @@ def generate_sample_gpu_single_process(
             capsw.append(' '.join(ww))
         return capsw
 
+    workers = None
+    if options.get('grad_sync'):
+        # independent workers (no grad_sync) decode every video themselves
+        workers = Workers(save_dir, options['grad_sync'], rank, world_size)
+
     def sample(whichset):
         samples = []
-        ctxs, ctx_masks = engine.prepare_data_for_blue(whichset)
-        for i, ctx, ctx_mask in zip(range(len(ctxs)), ctxs, ctx_masks):
-            print 'sampling %d/%d' % (i, len(ctxs))
+        videos = engine.prepare_data_for_blue(whichset)
+        # this worker's share of the videos
+        share = range(len(videos))
+        if workers is not None:
+            share = shard_ids(share, rank, world_size)
+        for i in share:
+            ctx, ctx_mask = videos[i]
+            print 'sampling %d/%d' % (i, len(videos))
             sample, score, _, _ = model.gen_sample(
                 None, f_init, f_next, ctx, ctx_mask, options,
                 None, beam, maxlen=MAXLEN)
@@ -141,6 +215,9 @@ def generate_sample_gpu_single_process(
             # print _seqs2words([sample])[0]
             samples.append(sample)
         samples = _seqs2words(samples)
+        if workers is not None:
+            samples = gather_samples(workers, uidx, whichset, share, samples,
+                                     len(videos))
         return samples
 
     if whichset == 'valid' or whichset == 'both':
@@ -167,7 +244,8 @@ def compute_score(
         whichset='both', on_cpu=True,
         processes=None, queue=None, rqueue=None, shared_params=None,
         one_time=False, metric=None,
-        f_init=None, f_next=None, model=None):
+        f_init=None, f_next=None, model=None,
+        rank=0, world_size=1, uidx=0):
     assert metric != 'perplexity'
     if on_cpu:
         raise NotImplementedError()
@@ -178,7 +256,8 @@ def compute_score(
             engine, model, f_init, f_next,
             save_dir=save_dir,
             beam=beam,
-            whichset=whichset)
+            whichset=whichset,
+            rank=rank, world_size=world_size, uidx=uidx)
 
     valid_score, test_score, imgToEval = score_with_cocoeval(samples_valid, samples_test, engine)
     scores_final = {}
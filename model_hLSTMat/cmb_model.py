@@ -5,6 +5,7 @@ from layers import Layers
 from _cmb_layers import CMBLayers
 from collections import OrderedDict
 import utils
+import perplexity
 import copy
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 import sys
@@ -139,7 +140,8 @@ class CMBModel(object):
         extra = [probs, alphas, betas]
         return trng, use_noise, x, mask, ctx, mask_ctx, cost, extra
 
-    def build_sampler(self, tparams, options, use_noise, trng, mode=None):
+    def build_sampler(self, tparams, options, use_noise, trng, mode=None,
+                      profile=False):
         # context: #annotations x dim
         ctx0 = tensor.matrix('ctx_sampler', dtype='float32')
         # ctx0.tag.test_value = numpy.random.uniform(size=(50,1024)).astype('float32')
@@ -169,7 +171,7 @@ class CMBModel(object):
             [ctx0, ctx_mask],
             [ctx0] + init_state + init_memory, name='f_init',
             on_unused_input='ignore',
-            profile=False, mode=mode)
+            profile=utils.profile_stats('f_init', profile), mode=mode)
         print 'Done'
 
         x = tensor.vector('x_sampler', dtype='int64')
@@ -237,7 +239,8 @@ class CMBModel(object):
         f_next = theano.function(
             [x, ctx0, ctx_mask] + init_state + init_memory,
             [next_probs, next_sample] + next_state + next_memory,
-            name='f_next', profile=False, mode=mode, on_unused_input='ignore')
+            name='f_next', profile=utils.profile_stats('f_next', profile),
+            mode=mode, on_unused_input='ignore')
         print 'Done'
         return f_init, f_next
 
@@ -384,42 +387,11 @@ class CMBModel(object):
 
         return sample, sample_score, next_state, next_memory
 
-    def pred_probs(self, engine, whichset, f_log_probs, verbose=True):
-
-        probs = []
-        n_done = 0
-        NLL = []
-        L = []
-        if whichset == 'train':
-            tags = engine.train
-            iterator = engine.kf_train
-        elif whichset == 'valid':
-            tags = engine.valid
-            iterator = engine.kf_valid
-        elif whichset == 'test':
-            tags = engine.test
-            iterator = engine.kf_test
-        else:
-            raise NotImplementedError()
-        n_samples = numpy.sum([len(index) for index in iterator])
-        for index in iterator:
-            tag = [tags[i] for i in index]
-            x, mask, ctx, ctx_mask = prepare_data(engine, tag)
-            pred_probs = f_log_probs(x, mask, ctx, ctx_mask)
-            L.append(mask.sum(0).tolist())
-            NLL.append((-1 * pred_probs).tolist())
-            probs.append(pred_probs.tolist())
-            n_done += len(tag)
-            if verbose:
-                sys.stdout.write('\rComputing LL on %d/%d examples' % (
-                    n_done, n_samples))
-                sys.stdout.flush()
-        print
-        probs = utils.flatten_list_of_list(probs)
-        NLL = utils.flatten_list_of_list(NLL)
-        L = utils.flatten_list_of_list(L)
-        perp = 2 ** (numpy.sum(NLL) / numpy.sum(L) / numpy.log(2))
-        return -1 * numpy.mean(probs), perp
+    def pred_probs(self, engine, whichset, f_log_probs, verbose=True,
+                   workers=None, key=None):
+        # whichset may be a list of sets, scored together
+        return perplexity.pred_probs(engine, whichset, f_log_probs, verbose=verbose,
+                                     workers=workers, key=key)
 
     def sample_execute(self, engine, options, tparams, f_init, f_next, x, ctx, ctx_mask, trng):
         stochastic = False
@@ -1,34 +1,66 @@
 import theano
 import numpy
 import theano.tensor as tensor
-from utils import itemlist
+from utils import itemlist, profile_stats
 
 # optimizers
-# name(hyperp, tparams, grads, inputs (list), cost) = f_grad_shared, f_update
-def adadelta(lr, tparams, grads, inp, cost, extra):
+# name(hyperp, tparams, grads, inputs (list), cost, extra) = f_grad_shared, f_update, state
+# f_grad_shared returns [cost, finite] + extra, where finite is 0 as soon as
+# the cost or a gradient is NaN/Inf. Keep extra to a few scalars in
+# training, its tensors are copied to the host at every update.
+# state lists the shared variables of the optimizer, saved to resume training.
+# It starts with the gradient buffers, one per parameter, which are the only
+# thing f_grad_shared writes: everything else is updated by f_update from the
+# buffers, so they can be averaged across workers in between.
+# With accum_steps > 1, f_grad_shared adds 1/accum_steps of the gradients of
+# a micro-batch to the buffers and f_update, called once every accum_steps
+# micro-batches, zeroes them: the update is that of the mean gradient.
+# profile keeps the Theano profiling stats of both functions in f.profile.
+def finite_flag(cost, grads):
+    # one reduction on the device instead of scanning every gradient on the host
+    g2 = 0.
+    for g in grads:
+        g2 += (g ** 2).sum()
+    bad = tensor.or_(tensor.isnan(cost), tensor.isinf(cost))
+    bad = tensor.or_(bad, tensor.or_(tensor.isnan(g2), tensor.isinf(g2)))
+    return tensor.eq(bad, 0)
+
+def accumulate(buffers, grads, accum_steps):
+    # updates of f_grad_shared and the resets to add to those of f_update
+    if accum_steps == 1:
+        return zip(buffers, grads), []
+    scale = numpy.float32(1. / accum_steps)
+    return ([(b, b + g * scale) for b, g in zip(buffers, grads)],
+            [(b, tensor.zeros_like(b)) for b in buffers])
+
+def adadelta(lr, tparams, grads, inp, cost, extra=[], accum_steps=1, profile=False):
     zipped_grads = [theano.shared(p.get_value() * numpy.float32(0.), name= '%s_grad' %k) for k, p in tparams.iteritems()]
     running_up2 = [theano.shared(p.get_value() * numpy.float32(0.), name= '%s_rup2' %k) for k, p in tparams.iteritems()]
     running_grads2 = [theano.shared(p.get_value() * numpy.float32(0.), name= '%s_rgrad2' %k) for k, p in tparams.iteritems()]
 
-    zgup = [(zg, g) for zg, g in zip(zipped_grads, grads)]
-    rg2up = [(rg2, 0.95 * rg2 + 0.05 * (g ** 2)) for rg2, g in zip(running_grads2, grads)]
+    zgup, zgreset = accumulate(zipped_grads, grads, accum_steps)
 
-    f_grad_shared = theano.function(inp, [cost] + extra, updates= zgup +rg2up,
-                                    profile=False, on_unused_input='ignore')
+    f_grad_shared = theano.function(inp, [cost, finite_flag(cost, grads)] + extra, updates= zgup,
+                                    profile=profile_stats('f_grad_shared', profile),
+                                    on_unused_input='ignore')
 
-    updir = [-tensor.sqrt(ru2 + 1e-6) / tensor.sqrt(rg2 + 1e-6) * zg for zg, ru2, rg2 in zip(zipped_grads, running_up2, running_grads2)]
+    rg2_new = [0.95 * rg2 + 0.05 * (zg ** 2) for zg, rg2 in zip(zipped_grads, running_grads2)]
+    rg2up = [(rg2, rg2n) for rg2, rg2n in zip(running_grads2, rg2_new)]
+    updir = [-tensor.sqrt(ru2 + 1e-6) / tensor.sqrt(rg2n + 1e-6) * zg for zg, ru2, rg2n in zip(zipped_grads, running_up2, rg2_new)]
     ru2up = [(ru2, 0.95 * ru2 + 0.05 * (ud ** 2)) for ru2, ud in zip(running_up2, updir)]
     param_up = [(p, p + ud) for p, ud in zip(itemlist(tparams), updir)]
 
-    f_update = theano.function([lr], [], updates= ru2up +param_up, on_unused_input='ignore', profile=False)
+    f_update = theano.function([lr], [], updates= rg2up + ru2up +param_up + zgreset, on_unused_input='ignore',
+                               profile=profile_stats('f_update', profile))
 
-    return f_grad_shared, f_update
+    return f_grad_shared, f_update, zipped_grads + running_up2 + running_grads2
 
-def adam(lr, tparams, grads, inp, cost):
+def adam(lr, tparams, grads, inp, cost, extra=[], accum_steps=1, profile=False):
     gshared = [theano.shared(p.get_value() * 0., name= '%s_grad' %k) for k, p in tparams.iteritems()]
-    gsup = [(gs, g) for gs, g in zip(gshared, grads)]
+    gsup, gsreset = accumulate(gshared, grads, accum_steps)
 
-    f_grad_shared = theano.function(inp, cost, updates=gsup)
+    f_grad_shared = theano.function(inp, [cost, finite_flag(cost, grads)] + extra, updates=gsup,
+                                    profile=profile_stats('f_grad_shared', profile))
 
     lr0 = 0.0002
     b1 = 0.1
@@ -37,15 +69,17 @@ def adam(lr, tparams, grads, inp, cost):
 
     updates = []
 
-    i = theano.shared(numpy.float32(0.))
+    i = theano.shared(numpy.float32(0.), name='adam_i')
     i_t = i + 1.
     fix1 = 1. - b1** (i_t)
     fix2 = 1. - b2 ** (i_t)
     lr_t = lr0 * (tensor.sqrt(fix2) / fix1)
 
-    for p, g in zip(tparams.values(), gshared):
-        m = theano.shared(p.get_value() * 0.)
-        v = theano.shared(p.get_value() * 0.)
+    state = []
+    for k, p, g in zip(tparams.keys(), tparams.values(), gshared):
+        m = theano.shared(p.get_value() * 0., name='%s_m' % k)
+        v = theano.shared(p.get_value() * 0., name='%s_v' % k)
+        state += [m, v]
         m_t = (b1 * g) + ((1. - b1) * m)
         v_t = (b2 * tensor.sqr(g)) + ((1. - b2) * v)
         g_t = m_t / (tensor.sqrt(v_t) + e)
@@ -54,13 +88,15 @@ def adam(lr, tparams, grads, inp, cost):
         updates.append((v, v_t))
         updates.append((p, p_t))
     updates.append((i, i_t))
+    updates += gsreset
 
-    f_update = theano.function([lr], [], updates=updates, on_unused_input='ignore')
+    f_update = theano.function([lr], [], updates=updates, on_unused_input='ignore',
+                               profile=profile_stats('f_update', profile))
 
-    return f_grad_shared, f_update
+    return f_grad_shared, f_update, gshared + state + [i]
 
 
-def rmsprop(lr, tparams, grads, inp, cost):
+def rmsprop(lr, tparams, grads, inp, cost, extra=[], accum_steps=1, profile=False):
     zipped_grads = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_grad' % k) for k, p in
                     tparams.iteritems()]
     running_grads = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_rgrad' % k) for k, p in
@@ -68,28 +104,33 @@ def rmsprop(lr, tparams, grads, inp, cost):
     running_grads2 = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_rgrad2' % k) for k, p in
                       tparams.iteritems()]
 
-    zgup = [(zg, g) for zg, g in zip(zipped_grads, grads)]
-    rgup = [(rg, 0.95 * rg + 0.05 * g) for rg, g in zip(running_grads, grads)]
-    rg2up = [(rg2, 0.95 * rg2 + 0.05 * (g ** 2)) for rg2, g in zip(running_grads2, grads)]
+    zgup, zgreset = accumulate(zipped_grads, grads, accum_steps)
 
-    f_grad_shared = theano.function(inp, cost, updates=zgup + rgup + rg2up, profile=False)
+    f_grad_shared = theano.function(inp, [cost, finite_flag(cost, grads)] + extra,
+                                    updates=zgup, profile=profile_stats('f_grad_shared', profile))
 
+    rg_new = [0.95 * rg + 0.05 * zg for rg, zg in zip(running_grads, zipped_grads)]
+    rg2_new = [0.95 * rg2 + 0.05 * (zg ** 2) for rg2, zg in zip(running_grads2, zipped_grads)]
+    rgup = zip(running_grads, rg_new) + zip(running_grads2, rg2_new)
     updir = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_updir' % k) for k, p in tparams.iteritems()]
     updir_new = [(ud, 0.9 * ud - 1e-4 * zg / tensor.sqrt(rg2 - rg ** 2 + 1e-4)) for ud, zg, rg, rg2 in
-                 zip(updir, zipped_grads, running_grads, running_grads2)]
+                 zip(updir, zipped_grads, rg_new, rg2_new)]
     param_up = [(p, p + udn[1]) for p, udn in zip(itemlist(tparams), updir_new)]
-    f_update = theano.function([lr], [], updates=updir_new + param_up, on_unused_input='ignore', profile=False)
+    f_update = theano.function([lr], [], updates=rgup + updir_new + param_up + zgreset, on_unused_input='ignore',
+                               profile=profile_stats('f_update', profile))
 
-    return f_grad_shared, f_update
+    return f_grad_shared, f_update, zipped_grads + running_grads + running_grads2 + updir
 
 
-def sgd(lr, tparams, grads, inp, cost):
+def sgd(lr, tparams, grads, inp, cost, extra=[], accum_steps=1, profile=False):
     gshared = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_grad' % k) for k, p in tparams.iteritems()]
-    gsup = [(gs, g) for gs, g in zip(gshared, grads)]
+    gsup, gsreset = accumulate(gshared, grads, accum_steps)
 
-    f_grad_shared = theano.function(inp, cost, updates=gsup, profile=False)
+    f_grad_shared = theano.function(inp, [cost, finite_flag(cost, grads)] + extra,
+                                    updates=gsup, profile=profile_stats('f_grad_shared', profile))
 
     pup = [(p, p - lr * g) for p, g in zip(itemlist(tparams), gshared)]
-    f_update = theano.function([lr], [], updates=pup, profile=False)
+    f_update = theano.function([lr], [], updates=pup + gsreset,
+                               profile=profile_stats('f_update', profile))
 
-    return f_grad_shared, f_update
\ No newline at end of file
+    return f_grad_shared, f_update, gshared
\ No newline at end of file
@@ -0,0 +1,366 @@
+'''
+Data-parallel training on one machine: n_workers processes run train() on
+their shard of every epoch (ShardedSampler) and average their gradients
+through files in shared memory between f_grad_shared and f_update, so
+every worker applies the same update and the parameters stay identical.
+The costs and decoding of the validation are split across the workers as
+well, through Workers; only rank 0 writes checkpoints, the other workers
+log to save_model_dir/worker<rank>.log.
+
+usage: python parallel.py n_workers [key=value ...]
+       python parallel.py n_workers [key=value ...] --benchmark [--steps 20]
+keys are those of config.attention. --benchmark times the updates with
+1, 2, 4, ... up to n_workers workers and reports samples/sec.
+'''
+import argparse
+import glob
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+
+import utils
+from config import config
+
+# int64 header of every worker file: steps published, stopped, pid
+HEADER = 3
+# seconds a worker waits for the others, at an update or an exchange
+TIMEOUT = 3600.
+
+
+def _create(path, n):
+    # written under another name and renamed, the other workers never
+    # map a half created file
+    f = open(path + '.tmp', 'wb')
+    f.write(numpy.array([0, 0, os.getpid()], dtype='int64').tostring())
+    f.truncate(HEADER * 8 + 2 * n * 4)
+    f.close()
+    os.rename(path + '.tmp', path)
+
+
+def _open(path, n, mode, poll):
+    # wait for the worker to create its file
+    while not (os.path.isfile(path) and
+               os.path.getsize(path) == HEADER * 8 + 2 * n * 4):
+        time.sleep(poll)
+    header = numpy.memmap(path, dtype='int64', mode=mode, shape=(HEADER,))
+    grads = numpy.memmap(path, dtype='float32', mode=mode, offset=HEADER * 8,
+                         shape=(2, n))
+    return header, grads
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+class GradientAverager(object):
+    def __init__(self, path, rank, world_size, buffers, poll=1e-4, timeout=TIMEOUT):
+        '''
+        buffers: the gradient shared variables of the optimizer, written
+        by f_grad_shared and read by f_update.
+        Every worker publishes its gradients in <path>.<rank>, in two
+        slots used in turn so that a worker can publish step s + 1 while
+        the others are still reading step s.
+        timeout: seconds to wait for the others at a step before giving
+        up, a worker that died is noticed within a second.
+        '''
+        self.rank = rank
+        self.world_size = world_size
+        self.buffers = buffers
+        self.poll = poll
+        self.timeout = timeout
+        self.shapes = [b.get_value(borrow=True).shape for b in buffers]
+        self.sizes = [int(numpy.prod(shape)) for shape in self.shapes]
+        n = sum(self.sizes)
+        self.step = 0
+        _create('%s.%d' % (path, rank), n)
+        self.files = [_open('%s.%d' % (path, r), n, 'r+' if r == rank else 'r', poll)
+                      for r in range(world_size)]
+
+    def average(self):
+        '''
+        Replace the gradients in the buffers by their mean over the
+        workers. False if a worker has stopped or died, the step is then
+        taken by none of them.
+        '''
+        slot = self.step % 2
+        header, grads = self.files[self.rank]
+        offset = 0
+        for b, size in zip(self.buffers, self.sizes):
+            grads[slot, offset:offset + size] = b.get_value(borrow=True).ravel()
+            offset += size
+        self.step += 1
+        # the counter goes last, the slot is complete when it is seen
+        header[0] = self.step
+        t0 = t_alive = time.time()
+        for k, (other_header, _) in enumerate(self.files):
+            while other_header[0] < self.step:
+                if other_header[1]:
+                    return False
+                if time.time() - t_alive > 1.:
+                    if not _alive(int(other_header[2])):
+                        print 'worker %d has died' % k
+                        return False
+                    t_alive = time.time()
+                if time.time() - t0 > self.timeout:
+                    raise RuntimeError('worker %d did not publish step %d in %g sec' % (
+                        k, self.step, self.timeout))
+                time.sleep(self.poll)
+        total = numpy.array(self.files[0][1][slot])
+        for _, other_grads in self.files[1:]:
+            total += other_grads[slot]
+        total /= self.world_size
+        offset = 0
+        for b, shape, size in zip(self.buffers, self.shapes, self.sizes):
+            b.set_value(total[offset:offset + size].reshape(shape), borrow=True)
+            offset += size
+        return True
+
+    def stop(self):
+        # the others leave their next average() with False
+        self.files[self.rank][0][1] = 1
+
+
+def shm_path():
+    root = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(root, 'capgen_grads_%d' % os.getpid())
+
+
+def remove_files(path, n_workers):
+    for r in range(n_workers):
+        for name in ['%s.%d' % (path, r), '%s.%d.tmp' % (path, r),
+                     '%s.result.%d' % (path, r)]:
+            if os.path.isfile(name):
+                os.remove(name)
+
+
+class Workers(object):
+    def __init__(self, save_dir, path, rank, world_size, poll=1., timeout=TIMEOUT):
+        '''
+        Exchange of small values (captions, costs) between the workers of
+        the run synchronized through path, by files in save_dir named
+        after the run; parallel.py removes them at the end.
+        '''
+        self.save_dir = save_dir
+        self.run = os.path.basename(path)
+        self.rank = rank
+        self.world_size = world_size
+        self.poll = poll
+        self.timeout = timeout
+
+    def _path(self, name, rank):
+        return os.path.join(self.save_dir, 'gather_%s_%s.%d.pkl' % (self.run, name, rank))
+
+    def all_gather(self, name, value):
+        '''
+        The value of every worker, in the order of the ranks. name tells
+        the exchanges of the run apart, e.g. samples_<uidx>_valid.
+        '''
+        path = self._path(name, self.rank)
+        # all workers wrote the previous file of this process, so they
+        # are done reading the ones before it
+        for old in _gathered[:-1]:
+            if os.path.isfile(old):
+                os.remove(old)
+        del _gathered[:-1]
+        utils.dump_pkl(value, path + '.tmp')
+        os.rename(path + '.tmp', path)
+        _gathered.append(path)
+        rval = []
+        t0 = time.time()
+        for k in range(self.world_size):
+            path = self._path(name, k)
+            while not os.path.isfile(path):
+                if time.time() - t0 > self.timeout:
+                    raise RuntimeError('no %s from worker %d after %g sec' % (
+                        name, k, self.timeout))
+                time.sleep(self.poll)
+            rval.append(utils.load_pkl(path))
+        return rval
+
+
+# the files written by Workers.all_gather in this process, oldest first
+_gathered = []
+
+
+def remove_gathered(save_dir, path):
+    # the exchanges of the run, once its workers are gone
+    for name in glob.glob(os.path.join(save_dir, 'gather_%s_*' % os.path.basename(path))):
+        os.remove(name)
+
+
+def bench_worker(options, rank, world_size, path, n_steps, n_warmup=2):
+    '''
+    The update loop of train() alone on n_steps minibatches assembled
+    beforehand: f_grad_shared, the gradient averaging and f_update.
+    Returns the samples and the seconds of the timed steps.
+    '''
+    from theano import tensor
+    import data_engine
+    import optimizers
+    from model_hLSTMat.lstm_nonlocal_model import LSTMNonLocalModel
+    from samplers import BucketSampler, ShardedSampler
+    from streaming_dataset import load_engine
+
+    engine = load_engine(options)
+    options['ctx_dim'] = engine.ctx_dim
+    options['n_words'] = engine.n_words
+    sampler = ShardedSampler(
+        BucketSampler(engine.caption_lengths(engine.train), options['batch_size'],
+                      max(options['n_buckets'], 1), maxlen=options['maxlen'],
+                      seed=config.random_seed),
+        rank, world_size, seed=config.random_seed, even=True)
+    kf = sampler.epoch_batches(0)[:n_warmup + n_steps]
+    assert len(kf) == n_warmup + n_steps, \
+        'only %d minibatches per worker' % len(kf)
+    batches = [data_engine.prepare_data(engine, [engine.train[i] for i in idx])
+               for idx in kf]
+
+    model = LSTMNonLocalModel()
+    tparams = utils.init_tparams(model.init_params(options))
+    trng, use_noise, x, mask, ctx, mask_ctx, cost, _ = \
+        model.build_model(tparams, options)
+    cost = cost.mean()
+    grads = tensor.grad(cost, wrt=utils.itemlist(tparams))
+    lr = tensor.scalar(name='lr')
+    f_grad_shared, f_update, optimizer_state = getattr(optimizers, options['optimizer'])(
+        lr, tparams, grads, [x, mask, ctx, mask_ctx], cost)
+    averager = None
+    if world_size > 1:
+        averager = GradientAverager(path, rank, world_size,
+                                    optimizer_state[:len(tparams)])
+    use_noise.set_value(1.)
+    t0 = time.time()
+    n_samples = 0
+    for i, (x, mask, ctx, ctx_mask) in enumerate(batches):
+        if i == n_warmup:
+            # the workers leave the warmup steps together
+            t0 = time.time()
+            n_samples = 0
+        f_grad_shared(x, mask, ctx, ctx_mask)
+        if averager is not None:
+            averager.average()
+        f_update(options['lrate'])
+        n_samples += x.shape[1]
+    return n_samples, time.time() - t0
+
+
+def launch(n_workers, args, save_model_dir, path, extra=[]):
+    # one process per rank, each with its share of the cores for BLAS
+    env = dict(os.environ)
+    env.setdefault('OMP_NUM_THREADS',
+                   str(max(1, multiprocessing.cpu_count() // n_workers)))
+    procs = []
+    for r in range(n_workers):
+        stdout = stderr = None
+        if r > 0:
+            stdout = open(os.path.join(save_model_dir, 'worker%d.log' % r), 'w')
+            stderr = subprocess.STDOUT
+        # key=value right after n_workers, argparse takes them as one group
+        cmd = [sys.executable, os.path.abspath(__file__), str(n_workers)] + args + \
+              ['--rank', str(r), '--sync', path] + extra
+        procs.append(subprocess.Popen(cmd, stdout=stdout, stderr=stderr, env=env))
+    # a worker that fails would leave the others waiting on its gradients
+    while True:
+        codes = [p.poll() for p in procs]
+        if any(code not in [None, 0] for code in codes):
+            for p in procs:
+                if p.poll() is None:
+                    p.terminate()
+            raise RuntimeError('worker exit codes %s' % codes)
+        if all(code == 0 for code in codes):
+            return
+        time.sleep(1.)
+
+
+def benchmark(max_workers, args, options, n_steps):
+    n = 1
+    rows = []
+    while n <= max_workers:
+        path = shm_path()
+        remove_files(path, n)
+        t0 = time.time()
+        launch(n, args, options['save_model_dir'], path,
+               ['--benchmark', '--steps', str(n_steps)])
+        results = [utils.load_pkl('%s.result.%d' % (path, r)) for r in range(n)]
+        remove_files(path, n)
+        n_samples = sum(s for s, _ in results)
+        seconds = max(t for _, t in results)
+        rows.append((n, n_samples / seconds))
+        print '%d workers: %d samples in %.2f sec, %.1f samples/sec (%.1f sec with compilation)' % (
+            n, n_samples, seconds, n_samples / seconds, time.time() - t0)
+        n *= 2
+    print '%8s %12s %8s %10s' % ('workers', 'samples/sec', 'speedup', 'efficiency')
+    for n, speed in rows:
+        print '%8d %12.1f %8.2f %10.2f' % (n, speed, speed / rows[0][1],
+                                           speed / rows[0][1] / n)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='data-parallel training')
+    parser.add_argument('n_workers', type=int)
+    parser.add_argument('options', nargs='*', help='key=value of config.attention')
+    parser.add_argument('--benchmark', action='store_true')
+    parser.add_argument('--steps', type=int, default=20,
+                        help='timed updates per worker of the benchmark')
+    # set by the launcher for the workers
+    parser.add_argument('--rank', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--sync', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    options = dict(config.attention)
+    try:
+        for arg in args.options:
+            k, v = arg.split('=')
+            if k not in options:
+                raise KeyError(k)
+            options[k] = utils.convert_from_string(v)
+    except (ValueError, KeyError):
+        print 'args must be like a=X with a in config.attention'
+        exit(1)
+    save_model_dir = options['save_model_dir']
+
+    if args.rank is not None:
+        if args.benchmark:
+            rval = bench_worker(options, args.rank, args.n_workers, args.sync, args.steps)
+            utils.dump_pkl(rval, '%s.result.%d' % (args.sync, args.rank))
+        else:
+            import train_model
+            options.update(rank=args.rank, world_size=args.n_workers,
+                           grad_sync=args.sync)
+            train_model.train(**options)
+        return
+
+    utils.create_dir_if_not_exist(save_model_dir)
+    if args.benchmark:
+        benchmark(args.n_workers, args.options, options, args.steps)
+        return
+    from checkpoint import RESUME_FILE
+    resuming = options['resume'] and \
+        os.path.isfile(os.path.join(save_model_dir, RESUME_FILE))
+    if config.erase_history and not resuming:
+        print 'erasing everything in ', save_model_dir
+        os.system('rm %s/*' % save_model_dir)
+    config.attention.update(options)
+    utils.dump_pkl(config, save_model_dir + 'model_config.pkl')
+    path = shm_path()
+    remove_files(path, args.n_workers)
+    t0 = time.time()
+    try:
+        launch(args.n_workers, args.options, save_model_dir, path)
+    finally:
+        remove_files(path, args.n_workers)
+        remove_gathered(save_model_dir, path)
+    print 'training time in total %.4f sec' % (time.time() - t0)
+
+
+if __name__ == '__main__':
+    main()
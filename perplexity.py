@@ -0,0 +1,153 @@
+'''
+Batched log-likelihood evaluation behind the pred_probs of the models.
+The word ids and masks of a set are assembled once, in minibatches of
+captions of similar length, and kept on the engine; at every validation
+only the contexts are gathered, by a thread that fills the next
+minibatches while f_log_probs runs, and the costs are written into
+preallocated arrays. Several sets (valid and test) go through one stream
+of minibatches. The workers of a data-parallel run score a share of the
+minibatches each and exchange the costs.
+'''
+import sys
+import threading
+import time
+from Queue import Queue
+
+import numpy
+
+from data_engine import BatchBuffers, fit_ring
+
+
+class EvalSet(object):
+    def __init__(self, engine, whichset, batch_size):
+        '''
+        The captions of whichset shorter than maxlen (prepare_data drops
+        the others), sorted by length so that the minibatches carry
+        little padding; the costs are order independent.
+        '''
+        self.whichset = whichset
+        tags = getattr(engine, whichset)
+        lengths = engine.caption_lengths(tags)
+        kept = numpy.arange(len(tags))
+        if engine.maxlen is not None:
+            kept = kept[lengths < engine.maxlen]
+        kept = kept[numpy.argsort(lengths[kept], kind='mergesort')]
+        # the end of sentence is a token as well
+        self.tokens = (lengths[kept] + 1).astype('float32')
+        self.nll = numpy.zeros(len(kept), dtype='float32')
+        # (offset in nll, x, mask, vidIDs)
+        self.batches = []
+        for start in range(0, len(kept), batch_size):
+            idx = kept[start:start + batch_size]
+            n_steps = lengths[idx].max() + 1
+            x = numpy.zeros((n_steps, len(idx)), dtype='int64')
+            mask = numpy.zeros((n_steps, len(idx)), dtype='float32')
+            for j, i in enumerate(idx):
+                x[:lengths[i], j] = engine.get_caption(tags[i])
+                mask[:lengths[i] + 1, j] = 1.
+            self.batches.append((start, x, mask, [tags[i].split('_')[0] for i in idx]))
+
+    def __len__(self):
+        return len(self.nll)
+
+    def result(self):
+        # (mean cost per caption, perplexity per token), those of pred_probs
+        return (self.nll.mean(dtype='float64'),
+                numpy.exp(self.nll.sum(dtype='float64') / self.tokens.sum()))
+
+
+def get_eval_set(engine, whichset):
+    '''
+    valid and test are built at the first validation and kept for the rest
+    of the process. train, scored once at the end, is not kept: it is all
+    of engine.train, not the shard of a worker.
+    '''
+    eval_set = engine.eval_sets.get(whichset)
+    if eval_set is None:
+        t0 = time.time()
+        eval_set = EvalSet(engine, whichset, engine.mb_size_test)
+        print 'assembled %d %s captions in %.2f sec' % (
+            len(eval_set), whichset, time.time() - t0)
+        if whichset != 'train':
+            engine.eval_sets[whichset] = eval_set
+    return eval_set
+
+
+def _gather(engine, jobs, queue, buffers):
+    # contexts of every minibatch, into the ring of buffers if there is one
+    try:
+        for i, (eval_set, (start, x, mask, vidIDs)) in enumerate(jobs):
+            # the contexts the decoding of the validation reads as well
+            contexts = engine.get_eval_contexts(eval_set.whichset)
+            if buffers is None:
+                ctx = numpy.zeros((len(vidIDs), engine.K, engine.ctx_dim), dtype='float32')
+                ctx_mask = numpy.zeros((len(vidIDs), engine.K), dtype='float32')
+            else:
+                ctx, ctx_mask = buffers[i % len(buffers)]
+                ctx = ctx[:len(vidIDs)]
+                ctx_mask = ctx_mask[:len(vidIDs)]
+            for j, vidID in enumerate(vidIDs):
+                ctx[j], ctx_mask[j] = contexts.get(vidID)
+            queue.put((True, (ctx, ctx_mask)))
+    except Exception:
+        # re-raised in the consumer thread
+        queue.put((False, sys.exc_info()))
+
+
+def pred_probs(engine, whichset, f_log_probs, verbose=True, depth=2,
+               workers=None, key=None):
+    '''
+    (mean cost, perplexity) of whichset, or a list of them for a list of
+    sets, scored in one pass.
+    workers: a parallel.Workers, every worker scores every world_size-th
+    minibatch and all of them get the same results. key tells the
+    exchanges of the run apart, e.g. the uidx.
+    '''
+    whichsets = [whichset] if isinstance(whichset, basestring) else whichset
+    eval_sets = [get_eval_set(engine, w) for w in whichsets]
+    jobs = [(s, batch) for s in eval_sets for batch in s.batches]
+    if workers is not None:
+        # sorted by length, the shares take as long
+        jobs = jobs[workers.rank::workers.world_size]
+    n_samples = sum(len(batch[3]) for _, batch in jobs)
+    if jobs:
+        batch_size = max(len(batch[3]) for _, batch in jobs)
+        # the minibatches in the queue, the one being scored and the one
+        # being gathered keep their buffers, depth cut to fit MAX_BUFFER_MB
+        buffers = None
+        fit = fit_ring(depth, BatchBuffers.nbytes(batch_size, 0, engine.K, engine.ctx_dim),
+                       'pred_probs')
+        if fit is not None:
+            depth = fit
+            buffers = [(numpy.zeros((batch_size, engine.K, engine.ctx_dim), dtype='float32'),
+                        numpy.zeros((batch_size, engine.K), dtype='float32'))
+                       for i in range(depth + 2)]
+        queue = Queue(maxsize=depth)
+        thread = threading.Thread(target=_gather, args=(engine, jobs, queue, buffers),
+                                  name='eval-gather')
+        thread.daemon = True
+        thread.start()
+    n_done = 0
+    for eval_set, (start, x, mask, vidIDs) in jobs:
+        ok, rval = queue.get()
+        if not ok:
+            thread.join()
+            raise rval[0], rval[1], rval[2]
+        ctx, ctx_mask = rval
+        eval_set.nll[start:start + len(vidIDs)] = -f_log_probs(x, mask, ctx, ctx_mask)
+        n_done += len(vidIDs)
+        if verbose:
+            sys.stdout.write('\rComputing LL on %d/%d examples' % (n_done, n_samples))
+            sys.stdout.flush()
+    if jobs:
+        thread.join()
+    if verbose:
+        print
+    if workers is not None:
+        share = [(eval_sets.index(s), start, s.nll[start:start + len(vidIDs)])
+                 for s, (start, x, mask, vidIDs) in jobs]
+        for other in workers.all_gather('nll_%s_%s' % (key, '-'.join(whichsets)), share):
+            for k, start, nll in other:
+                eval_sets[k].nll[start:start + len(nll)] = nll
+    rval = [s.result() for s in eval_sets]
+    return rval[0] if isinstance(whichset, basestring) else rval
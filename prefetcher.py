@@ -0,0 +1,105 @@
+'''
+Background minibatch assembly: worker threads run data_engine.prepare_data
+for the next few minibatches while the compiled update is running.
+numpy file reads and copies release the GIL, so threads are enough here
+and the engine (memory maps, caches) is shared without pickling.
+'''
+import sys
+import threading
+import time
+
+import data_engine
+
+
+class BatchPrefetcher(object):
+    def __init__(self, engine, tag_batches, depth=4, n_workers=1):
+        '''
+        tag_batches: list of minibatches, each a list of tags.
+        depth: how many assembled minibatches may wait in the queue,
+               0 assembles them synchronously in the caller's thread.
+        Batches are yielded in the order of tag_batches whatever the
+        number of workers.
+        '''
+        self.engine = engine
+        self.tag_batches = tag_batches
+        self.depth = depth
+        self.n_workers = n_workers
+        # seconds the consumer was blocked on the last batch
+        self.wait_time = 0.
+        self._cond = threading.Condition()
+        self._results = {}
+        self._next_job = 0
+        self._consumed = 0
+        self._stopped = False
+        self._threads = []
+        self.buffers = None
+        if engine.maxlen is not None and tag_batches:
+            # the batches waiting in the queue, the one being consumed and
+            # the one the consumer got before it keep their slots; the
+            # depth is cut to fit in MAX_BUFFER_MB
+            batch_size = max(len(tags) for tags in tag_batches)
+            depth = data_engine.fit_ring(self.depth, data_engine.BatchBuffers.nbytes(
+                batch_size, engine.maxlen, engine.K, engine.ctx_dim), 'prefetcher')
+            if depth is not None:
+                self.depth = depth
+                self.buffers = data_engine.BatchBuffers(
+                    self.depth + 2, batch_size, engine.maxlen, engine.K, engine.ctx_dim)
+        if self.depth > 0:
+            for i in range(self.n_workers):
+                t = threading.Thread(target=self._work,
+                                     name='prefetch-%d' % i)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._stopped and \
+                        self._next_job < len(self.tag_batches) and \
+                        self._next_job >= self._consumed + self.depth:
+                    self._cond.wait(1.)
+                if self._stopped or self._next_job >= len(self.tag_batches):
+                    return
+                i = self._next_job
+                self._next_job += 1
+            try:
+                rval = (True, data_engine.prepare_data(
+                    self.engine, self.tag_batches[i], self.buffers, i))
+            except Exception:
+                # re-raised in the consumer thread
+                rval = (False, sys.exc_info())
+            with self._cond:
+                self._results[i] = rval
+                self._cond.notify_all()
+
+    def __iter__(self):
+        try:
+            for i, tags in enumerate(self.tag_batches):
+                t0 = time.time()
+                if self.depth > 0:
+                    with self._cond:
+                        while i not in self._results:
+                            self._cond.wait(1.)
+                        ok, batch = self._results.pop(i)
+                        self._consumed = i + 1
+                        self._cond.notify_all()
+                    if not ok:
+                        raise batch[0], batch[1], batch[2]
+                else:
+                    batch = data_engine.prepare_data(self.engine, tags,
+                                                     self.buffers, i)
+                self.wait_time = time.time() - t0
+                yield tags, batch
+        finally:
+            self.close()
+
+    def close(self):
+        # safe to call more than once; waits for the batches in flight
+        with self._cond:
+            self._stopped = True
+            self._results.clear()
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
@@ -0,0 +1,126 @@
+'''
+Profile a dataset against a training config before a run: frame-count and
+caption-length histograms, the captions prepare_data drops at maxlen, the
+padding of the minibatches and the size of the per-minibatch tensors of
+every model variant.
+
+usage: python profile_dataset.py [key=value ...]
+keys are those of config.attention, e.g. batch_size=32 maxlen=40 K=1372
+'''
+import sys
+
+import numpy
+
+import utils
+from config import config
+from samplers import BucketSampler, padding_efficiency
+from streaming_dataset import load_engine
+
+MODELS = ['Model', 'CMBModel', 'NonLocalModel', 'LSTMNonLocalModel']
+
+
+def print_histogram(name, values, bins=10):
+    values = numpy.asarray(values)
+    counts, edges = numpy.histogram(values, bins=bins)
+    print '%s: n %d, min %d, mean %.1f, p50 %d, p95 %d, max %d' % (
+        name, len(values), values.min(), values.mean(),
+        numpy.percentile(values, 50), numpy.percentile(values, 95), values.max())
+    for c, lo, hi in zip(counts, edges[:-1], edges[1:]):
+        print '  [%7.1f, %7.1f) %7d %s' % (lo, hi, c, '#' * int(50. * c / max(counts.max(), 1)))
+
+
+def tensor_bytes(options, model_name, n_steps):
+    '''
+    Bytes of the main tensors of one training minibatch: inputs, the
+    softmax over the vocabulary, attention weights and, for the non-local
+    variants, the frame affinities and self-attention LSTM states.
+    '''
+    B = options['batch_size']
+    K = options['K']
+    D = options['ctx_dim']
+    rval = [('x + mask', n_steps * B * (8 + 4)),
+            ('ctx + ctx_mask', B * K * (D + 1) * 4),
+            ('probs', n_steps * B * options['n_words'] * 4),
+            ('alphas', n_steps * B * K * 4),
+            ('decoder states', n_steps * B * options['dim'] * 4 * 4)]
+    if model_name in ['NonLocalModel', 'LSTMNonLocalModel']:
+        # theta/phi/g projections and the K x K affinities
+        rval.append(('non-local', B * (3 * K * D + K * K) * 4))
+    if model_name == 'LSTMNonLocalModel':
+        # scan over T steps of B * K rows of 4 * ctx_dim gates and states
+        rval.append(('self-att lstm', options['T'] * B * K * 6 * D * 4))
+    return rval
+
+
+def profile(options):
+    engine = load_engine(options)
+    options['ctx_dim'] = engine.ctx_dim
+    options['n_words'] = engine.n_words
+    maxlen = options['maxlen']
+
+    print '=== frames per video (K=%d)' % options['K']
+    vidIDs = sorted(set(tag.split('_')[0]
+                        for tag in engine.train + engine.valid + engine.test))
+    n_frames = [engine.frame_manifest.n_frames(vidID) for vidID in vidIDs]
+    print_histogram('frames', n_frames)
+    print '%.1f%% of the videos have fewer than K frames and are padded' % (
+        100. * numpy.mean(numpy.asarray(n_frames) < options['K']))
+
+    # None keeps every caption, as in prepare_data
+    print '=== caption lengths (maxlen=%s)' % maxlen
+    for whichset in ['train', 'valid', 'test']:
+        lengths = engine.caption_lengths(getattr(engine, whichset))
+        print_histogram(whichset, lengths)
+        if maxlen is not None:
+            print '  %.2f%% (%d) dropped by prepare_data at length >= maxlen' % (
+                100. * numpy.mean(lengths >= maxlen), (lengths >= maxlen).sum())
+
+    print '=== padding of the training minibatches'
+    lengths = engine.caption_lengths(engine.train)
+    kept = numpy.arange(len(lengths))
+    if maxlen is not None:
+        kept = kept[lengths < maxlen]
+    chunked = utils.generate_minibatch_idx(len(kept), options['batch_size'])
+    print 'fixed chunks: efficiency %.3f' % padding_efficiency(
+        lengths, [kept[idx] for idx in chunked])
+    if options['n_buckets'] > 0:
+        sampler = BucketSampler(lengths, options['batch_size'], options['n_buckets'],
+                                maxlen=maxlen, seed=config.random_seed)
+        batches = sampler.epoch_batches(0)
+        print '%d buckets: efficiency %.3f' % (
+            options['n_buckets'], sampler.padding_efficiency(batches))
+    else:
+        batches = [kept[idx] for idx in chunked]
+    steps = numpy.asarray([lengths[idx].max() + 1 for idx in batches])
+    print_histogram('minibatch steps', steps)
+    # the longest minibatch without a cut-off
+    max_steps = maxlen if maxlen is not None else int(steps.max())
+
+    print '=== per-minibatch tensors, batch_size %d, at p95 steps %d / max %d' % (
+        options['batch_size'], numpy.percentile(steps, 95), max_steps)
+    for model_name in MODELS:
+        p95 = tensor_bytes(options, model_name, int(numpy.percentile(steps, 95)))
+        worst = tensor_bytes(options, model_name, max_steps)
+        print model_name
+        for (name, b), (_, w) in zip(p95, worst):
+            print '  %-16s %10.1f MB %10.1f MB' % (name, b / 2. ** 20, w / 2. ** 20)
+        print '  %-16s %10.1f MB %10.1f MB' % (
+            'total', sum(b for _, b in p95) / 2. ** 20, sum(w for _, w in worst) / 2. ** 20)
+
+
+def main():
+    options = dict(config.attention)
+    try:
+        for arg in sys.argv[1:]:
+            k, v = arg.split('=')
+            if k not in options:
+                raise KeyError(k)
+            options[k] = utils.convert_from_string(v)
+    except (ValueError, KeyError):
+        print 'args must be like a=X with a in config.attention'
+        exit(1)
+    profile(options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+'''
+Op-level profiling of the compiled functions of train(): with profile=True
+the functions are compiled with utils.profile_stats, their per-op time and
+memory tables are written to save_model_dir/profile_<function>.txt and the
+ops taking the most time over all of them are printed at every validation.
+
+A scan is reported as a single op here. Theano only records the shapes
+behind the memory tables with theano.config.profile on, which also makes
+it run the functions on its Python VM, so the times are those of that VM,
+and profiles the inner functions of the scans, printed at exit;
+profile_memory=False keeps the C VM and leaves the memory tables out.
+'''
+import os
+
+import theano
+
+
+def enable(memory=True):
+    # before compiling the functions, the linker is chosen then
+    if memory:
+        theano.config.profile = True
+        theano.config.profile_memory = True
+
+
+def profiled(functions):
+    # the functions compiled with a profile that have been called
+    return [f for f in functions
+            if f.profile and f.profile.fct_callcount > 0]
+
+
+def dump_profiles(functions, save_dir, suffix='', n_ops=100, n_apply=50):
+    for f in profiled(functions):
+        path = os.path.join(save_dir, 'profile_%s%s.txt' % (f.profile.message, suffix))
+        with open(path + '.tmp', 'w') as out:
+            f.profile.summary(file=out, n_ops_to_print=n_ops,
+                              n_apply_to_print=n_apply)
+        os.rename(path + '.tmp', path)
+
+
+def hot_ops(functions, n=20):
+    '''
+    [(seconds, % of the profiled time, function, op)] of the n ops that
+    took the most time, over the calls of all the functions so far.
+    '''
+    rval = []
+    for f in profiled(functions):
+        for op, t in f.profile.op_time().iteritems():
+            rval.append((t, f.profile.message, str(op)))
+    total = max(sum(t for t, _, _ in rval), 1e-12)
+    rval.sort(reverse=True)
+    return [(t, 100. * t / total, name, op) for t, name, op in rval[:n]]
+
+
+def report(functions, save_dir, n=20, suffix=''):
+    dump_profiles(functions, save_dir, suffix)
+    print '%d hottest ops (tables in %sprofile_*%s.txt)' % (n, save_dir, suffix)
+    print '%10s %7s %6s  %-14s %s' % ('sec', '%', 'calls', 'function', 'op')
+    calls = dict((f.profile.message, f.profile.fct_callcount)
+                 for f in profiled(functions))
+    for t, percent, name, op in hot_ops(functions, n):
+        print '%10.3f %6.1f%% %6d  %-14s %s' % (t, percent, calls[name], name, op[:80])
@@ -0,0 +1,126 @@
+'''
+Minibatch samplers producing kf_train-style index lists
+[m1, m2, ..., mk] where mk is a list of indices into engine.train.
+'''
+import numpy
+
+
+def padding_efficiency(lengths, minibatch_idx):
+    # fraction of the (maxlen + 1) x n_samples x_mask entries that are real
+    # tokens (the +1 is the <eos> step, as in prepare_data)
+    real = 0
+    padded = 0
+    for idx in minibatch_idx:
+        l = lengths[idx] + 1
+        real += l.sum()
+        padded += l.max() * len(idx)
+    return real / float(max(padded, 1))
+
+
+class BucketSampler(object):
+    def __init__(self, lengths, batch_size, n_buckets=10, maxlen=None, seed=1234):
+        '''
+        lengths: caption length of every training sample.
+        Samples are sorted by length and cut into n_buckets buckets of
+        equal size; every epoch shuffles within the buckets, cuts them
+        into minibatches and shuffles the minibatches. Captions that
+        prepare_data would drop (length >= maxlen) are left out so
+        minibatches stay full.
+        '''
+        self.lengths = numpy.asarray(lengths)
+        self.batch_size = batch_size
+        self.seed = seed
+        idx = numpy.arange(len(self.lengths))
+        if maxlen is not None:
+            idx = idx[self.lengths < maxlen]
+        self.n_dropped = len(self.lengths) - len(idx)
+        # stable sort keeps the order deterministic among equal lengths
+        idx = idx[numpy.argsort(self.lengths[idx], kind='mergesort')]
+        self.buckets = [b for b in numpy.array_split(idx, n_buckets) if len(b) > 0]
+
+    def epoch_batches(self, eidx):
+        # the same epoch always gives the same minibatches
+        rng = numpy.random.RandomState(self.seed + eidx)
+        minibatch_idx = []
+        leftover = []
+        for bucket in self.buckets:
+            bucket = bucket[rng.permutation(len(bucket))]
+            n_full = len(bucket) // self.batch_size * self.batch_size
+            if n_full > 0:
+                minibatch_idx += numpy.split(bucket[:n_full], n_full // self.batch_size)
+            leftover.append(bucket[n_full:])
+        # the tails of neighbouring buckets have similar lengths
+        leftover = numpy.concatenate(leftover)
+        for i in range(0, len(leftover), self.batch_size):
+            minibatch_idx.append(leftover[i:i + self.batch_size])
+        order = rng.permutation(len(minibatch_idx))
+        return [minibatch_idx[i].tolist() for i in order]
+
+    def padding_efficiency(self, minibatch_idx):
+        return padding_efficiency(self.lengths, minibatch_idx)
+
+
+def balanced_split(costs, n_shards):
+    '''
+    Split the items of costs into n_shards lists with close total costs
+    and item counts differing by at most one: items are dealt in rounds
+    of n_shards from the most to the least costly, the cheapest shard
+    so far taking the most costly item of the round.
+    Deterministic, ties go to the lower shard.
+    '''
+    costs = numpy.asarray(costs)
+    order = numpy.argsort(-costs, kind='mergesort')
+    shards = [[] for _ in range(n_shards)]
+    totals = numpy.zeros(n_shards)
+    for i in range(0, len(order), n_shards):
+        round_ = order[i:i + n_shards]
+        # stable sort, so equal totals keep the shard order
+        takers = numpy.argsort(totals, kind='mergesort')[:len(round_)]
+        for item, shard in zip(round_, takers):
+            shards[shard].append(item)
+            totals[shard] += costs[item]
+    return shards, totals
+
+
+class ShardedSampler(object):
+    def __init__(self, sampler, rank=0, world_size=1, seed=1234, even=False):
+        '''
+        Minibatches of one of world_size workers: every worker builds the
+        same epoch of minibatches with sampler (a BucketSampler), they are
+        split across the workers balanced by caption tokens and each
+        worker keeps the ones of its rank, so the workers read disjoint
+        parts of the training set.
+        even: every worker gets the same number of minibatches, the
+        cheapest one of the larger shards is left out. Workers that
+        average their gradients at every update need it.
+        '''
+        assert 0 <= rank < world_size
+        self.sampler = sampler
+        self.lengths = sampler.lengths
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.even = even
+
+    def epoch_batches(self, eidx):
+        minibatch_idx = self.sampler.epoch_batches(eidx)
+        # tokens, <eos> included, as counted by padding_efficiency
+        tokens = [(self.lengths[idx] + 1).sum() for idx in minibatch_idx]
+        shards, _ = balanced_split(tokens, self.world_size)
+        # the split goes by size, shuffle again so long and short
+        # minibatches alternate
+        rng = numpy.random.RandomState(self.seed + eidx + 1000 * self.rank)
+        mine = shards[self.rank]
+        if self.even:
+            # shards are dealt most costly first
+            mine = mine[:len(minibatch_idx) // self.world_size]
+        return [minibatch_idx[mine[i]] for i in rng.permutation(len(mine))]
+
+    def padding_efficiency(self, minibatch_idx):
+        return padding_efficiency(self.lengths, minibatch_idx)
+
+
+def shard_ids(ids, rank=0, world_size=1):
+    # every world_size-th id starting at rank, for decoding where the cost
+    # is about the same per video
+    return ids[rank::world_size]
@@ -0,0 +1,134 @@
+'''
+Compare packed feature stores (float16, int8, PCA projected, ...) with a
+float32 reference store: size and reconstruction error over the videos
+and, given trained models, the parameter and context memory, decoding
+time and change of the valid/test caption scores.
+
+usage: python store_report.py ref_store store [store ...]
+           [--model_dir model_files/ --model_file model_best_so_far.npz]
+--model_dir is given once to score every store with the same model, or
+once per store (reference first) when the stores differ in ctx_dim.
+'''
+import argparse
+import os
+import time
+
+import numpy
+
+import utils
+from feature_store import FeatureStore
+
+SCORES = ['Bleu_4', 'METEOR', 'ROUGE_L', 'CIDEr']
+
+
+def reconstruction_error(ref, store, vidIDs):
+    se = 0.
+    norm = 0.
+    max_abs = 0.
+    for vidID in vidIDs:
+        a = ref[vidID]
+        b = store.reconstruct(vidID)
+        se += ((a - b) ** 2).sum()
+        norm += (a ** 2).sum()
+        max_abs = max(max_abs, numpy.abs(a - b).max())
+    return numpy.sqrt(se / max(norm, 1e-8)), max_abs
+
+
+def store_bytes(store):
+    return os.path.getsize(os.path.join(store.root, 'feats.npy'))
+
+
+def load_model(model_name):
+    from model_hLSTMat.model import Model
+    from model_hLSTMat.cmb_model import CMBModel
+    from model_hLSTMat.non_local_model import NonLocalModel
+    from model_hLSTMat.lstm_nonlocal_model import LSTMNonLocalModel
+    return eval(model_name)()
+
+
+def model_cost(model_dir, model_name, store):
+    # parameter memory, and memory of one training minibatch of contexts
+    model_options = utils.load_pkl(os.path.join(model_dir, 'model_options.pkl'))
+    assert model_options['ctx_dim'] == store.ctx_dim, \
+        'model trained with ctx_dim %d' % model_options['ctx_dim']
+    params = load_model(model_name).init_params(model_options)
+    n_params = sum(p.size for p in params.values())
+    ctx_bytes = model_options['batch_size'] * store.K * store.ctx_dim * 4
+    return n_params, ctx_bytes
+
+
+def caption_scores(model_dir, model_file, model_name, store_dir):
+    import theano
+    from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+    from streaming_dataset import load_engine
+    import metrics
+
+    model_options = utils.load_pkl(os.path.join(model_dir, 'model_options.pkl'))
+    engine = load_engine(model_options, feature_store=store_dir)
+    model = load_model(model_name)
+    params = model.init_params(model_options)
+    params = utils.load_params(os.path.join(model_dir, model_file), params)
+    tparams = utils.init_tparams(params)
+    use_noise = theano.shared(numpy.float32(0.))
+    trng = RandomStreams(1234)
+    f_init, f_next = model.build_sampler(tparams, model_options, use_noise, trng)
+    save_dir = os.path.join(model_dir, 'store_report', os.path.basename(
+        os.path.normpath(store_dir)))
+    utils.create_dir_if_not_exist(save_dir)
+    scores = metrics.compute_score(
+        model_type='attention', model_archive=params, options=model_options,
+        engine=engine, save_dir=save_dir, beam=5, n_process=5,
+        whichset='both', on_cpu=False, metric=model_options['metric'],
+        one_time=True, f_init=f_init, f_next=f_next, model=model)
+    return scores
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare feature stores')
+    parser.add_argument('ref_store')
+    parser.add_argument('stores', nargs='+')
+    parser.add_argument('--model_dir', action='append', default=[])
+    parser.add_argument('--model_file', default='model_best_so_far.npz')
+    parser.add_argument('--model', default='LSTMNonLocalModel')
+    args = parser.parse_args()
+
+    ref = FeatureStore(args.ref_store)
+    vidIDs = sorted(ref.vid_index.keys())
+    print '%-30s %-8s %8s %10s %10s %10s' % (
+        'store', 'encoding', 'ctx_dim', 'MB', 'rel rmse', 'max abs')
+    print '%-30s %-8s %8d %10.1f %10s %10s' % (
+        args.ref_store, ref.encoding, ref.ctx_dim, store_bytes(ref) / 2. ** 20, '-', '-')
+    for store_dir in args.stores:
+        store = FeatureStore(store_dir)
+        rmse, max_abs = reconstruction_error(ref, store, vidIDs)
+        print '%-30s %-8s %8d %10.1f %10.5f %10.5f' % (
+            store_dir, store.encoding, store.ctx_dim, store_bytes(store) / 2. ** 20,
+            rmse, max_abs)
+
+    if not args.model_dir:
+        return
+    store_dirs = [args.ref_store] + args.stores
+    model_dirs = args.model_dir
+    if len(model_dirs) == 1:
+        model_dirs = model_dirs * len(store_dirs)
+    assert len(model_dirs) == len(store_dirs), 'one --model_dir per store'
+    print '%-30s %12s %14s' % ('store', 'params (MB)', 'ctx batch (MB)')
+    for store_dir, model_dir in zip(store_dirs, model_dirs):
+        n_params, ctx_bytes = model_cost(model_dir, args.model, FeatureStore(store_dir))
+        print '%-30s %12.1f %14.1f' % (store_dir, n_params * 4 / 2. ** 20, ctx_bytes / 2. ** 20)
+    ref_scores = None
+    for store_dir, model_dir in zip(store_dirs, model_dirs):
+        t0 = time.time()
+        scores = caption_scores(model_dir, args.model_file, args.model, store_dir)
+        if ref_scores is None:
+            ref_scores = scores
+        for whichset in ['valid', 'test']:
+            print '%s %s (%.1f sec):' % (store_dir, whichset, time.time() - t0),
+            for k in SCORES:
+                print '%s %.4f (%+.4f)' % (k, scores[whichset][k],
+                                           scores[whichset][k] - ref_scores[whichset][k]),
+            print
+
+
+if __name__ == '__main__':
+    main()
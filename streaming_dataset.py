@@ -0,0 +1,164 @@
+'''
+Manifest-driven dataset for corpora too large to keep every caption in
+memory (MSR-VTT and up). A dataset directory holds
+
+    manifest.pkl   signature, worddict file, the tags and video ids of
+                   train/valid/test and the list of shards
+    shard_*.pkl    {vidID: captions} for a few hundred videos each
+
+Captions are read a shard at a time and only the last max_shards shards
+stay in memory. StreamingMovie2Caption keeps the Movie2Caption interface,
+so train(), pred_probs and the metrics use it unchanged.
+
+usage: python streaming_dataset.py out_dir [--dataset youtube2text]
+writes the shards of an existing train/valid/test/CAP.pkl dataset.
+'''
+import argparse
+import os
+import threading
+from collections import OrderedDict
+
+import utils
+from data_engine import Movie2Caption
+
+MANIFEST_FILE = 'manifest.pkl'
+
+
+class ShardedCaptions(object):
+    '''
+    vidID -> captions, backed by the shards of a dataset directory.
+    '''
+    def __init__(self, root, shards, max_shards=4):
+        self.root = root
+        self.shards = shards
+        self.max_shards = max_shards
+        self.shard_of = {}
+        for i, shard in enumerate(shards):
+            for vidID in shard['vids']:
+                self.shard_of[vidID] = i
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.shard_of)
+
+    def __contains__(self, vidID):
+        return vidID in self.shard_of
+
+    def keys(self):
+        return [vidID for shard in self.shards for vidID in shard['vids']]
+
+    def load_shard(self, i):
+        with self._lock:
+            shard = self._loaded.pop(i, None)
+            if shard is None:
+                shard = utils.load_pkl(os.path.join(self.root, self.shards[i]['file']))
+                if len(self._loaded) >= self.max_shards:
+                    self._loaded.popitem(last=False)
+            # most recently used goes last
+            self._loaded[i] = shard
+        return shard
+
+    def __getitem__(self, vidID):
+        return self.load_shard(self.shard_of[vidID])[vidID]
+
+    def iter_shards(self):
+        # one pass over all captions, holding a single shard at a time
+        for shard in self.shards:
+            yield utils.load_pkl(os.path.join(self.root, shard['file']))
+
+
+class StreamingMovie2Caption(Movie2Caption):
+    def __init__(self, model_type, signature, video_feature,
+                 mb_size_train, mb_size_test, maxlen, n_words,
+                 n_frames=None, outof=None, manifest=None, max_shards=4,
+                 **kwargs):
+        # signature is taken from the manifest, the argument only has to match
+        self.manifest_root = manifest
+        self.max_shards = max_shards
+        self.manifest = utils.load_pkl(os.path.join(manifest, MANIFEST_FILE))
+        assert signature == self.manifest['signature'], \
+            'manifest is for %s' % self.manifest['signature']
+        super(StreamingMovie2Caption, self).__init__(
+            model_type, signature, video_feature,
+            mb_size_train, mb_size_test, maxlen, n_words,
+            n_frames=n_frames, outof=outof, **kwargs)
+
+    def load_splits(self):
+        manifest = self.manifest
+        self.train = manifest['train']
+        self.valid = manifest['valid']
+        self.test = manifest['test']
+        self.train_ids = manifest['train_ids']
+        self.valid_ids = manifest['valid_ids']
+        self.test_ids = manifest['test_ids']
+        self.worddict_file = os.path.join(self.manifest_root, manifest['worddict'])
+
+    def load_indexed_captions(self):
+        return ShardedCaptions(self.manifest_root, self.manifest['shards'],
+                               self.max_shards)
+
+    def iter_captions(self):
+        for shard in self.CAP.iter_shards():
+            for vidID, caps in shard.iteritems():
+                yield vidID, caps
+
+    def caption_source_files(self):
+        return [os.path.join(self.manifest_root, MANIFEST_FILE), self.worddict_file]
+
+
+def load_engine(options, **kwargs):
+    '''
+    The engine of the train() options, e.g. a saved model_options.pkl:
+    a StreamingMovie2Caption with dataset_manifest, a Movie2Caption
+    otherwise. kwargs override the options, e.g. feature_store.
+    '''
+    # options saved before these keys existed read the <vid>.npy files
+    kwargs.setdefault('feature_store', options.get('feature_store'))
+    kwargs.setdefault('feature_cache_mb', options.get('feature_cache_mb', 0))
+    engine_class = Movie2Caption
+    if options.get('dataset_manifest'):
+        engine_class = StreamingMovie2Caption
+        kwargs['manifest'] = options['dataset_manifest']
+    return engine_class('attention', options['dataset'],
+                        options['video_feature'],
+                        options['batch_size'], options['valid_batch_size'],
+                        options['maxlen'], options['n_words'],
+                        options['K'], options['OutOf'], **kwargs)
+
+
+def write_shards(engine, out_dir, shard_size=500):
+    # shard the captions of any Movie2Caption and write the manifest
+    utils.create_dir_if_not_exist(out_dir)
+    vidIDs = sorted(engine.CAP.keys())
+    shards = []
+    for i in range(0, len(vidIDs), shard_size):
+        vids = vidIDs[i:i + shard_size]
+        name = 'shard_%05d.pkl' % len(shards)
+        utils.dump_pkl(OrderedDict((vidID, engine.CAP[vidID]) for vidID in vids),
+                       os.path.join(out_dir, name))
+        shards.append({'file': name, 'vids': vids})
+    worddict = os.path.basename(engine.worddict_file)
+    utils.dump_pkl(engine.worddict, os.path.join(out_dir, worddict))
+    manifest = {'signature': engine.signature, 'worddict': worddict,
+                'train': engine.train, 'valid': engine.valid, 'test': engine.test,
+                'train_ids': engine.train_ids, 'valid_ids': engine.valid_ids,
+                'test_ids': engine.test_ids, 'shards': shards}
+    # the manifest goes last, shards without it are never read
+    utils.dump_pkl(manifest, os.path.join(out_dir, MANIFEST_FILE))
+    print 'wrote %d videos in %d shards to %s' % (len(vidIDs), len(shards), out_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='shard a caption dataset')
+    parser.add_argument('out_dir')
+    parser.add_argument('--dataset', default='youtube2text')
+    parser.add_argument('--shard_size', type=int, default=500)
+    args = parser.parse_args()
+    engine = Movie2Caption('attention', args.dataset, 'googlenet',
+                           1, 1, None, 20000)
+    write_shards(engine, args.out_dir, args.shard_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+'''
+The valid and test features are read once per run, however many
+validations (batched perplexity and beam search decoding) read them.
+
+usage: python -m unittest discover tests
+'''
+import threading
+import unittest
+from collections import OrderedDict, defaultdict
+
+import numpy
+
+import data_engine
+import perplexity
+
+
+class StubEngine(data_engine.Movie2Caption):
+    # a few videos of random frames, nothing read from disk but counted
+    def __init__(self, n_videos=6, K=4, ctx_dim=5):
+        self.video_feature = 'googlenet'
+        self.feature_store = None
+        self.feature_cache = None
+        self.K = K
+        self.ctx_dim = ctx_dim
+        self.maxlen = None
+        self.mb_size_test = 4
+        self.ctx_masks = OrderedDict()
+        self._mask_lock = threading.Lock()
+        self.eval_contexts = {}
+        self.eval_sets = {}
+        self.valid_ids = ['vid%d' % i for i in range(n_videos / 2)]
+        self.test_ids = ['vid%d' % i for i in range(n_videos / 2, n_videos)]
+        self.valid = ['%s_%d' % (vidID, c) for vidID in self.valid_ids for c in range(3)]
+        self.test = ['%s_%d' % (vidID, c) for vidID in self.test_ids for c in range(3)]
+        self.reads = defaultdict(int)
+
+    def read_sub_frames(self, vidID):
+        self.reads[vidID] += 1
+        rng = numpy.random.RandomState(int(vidID[3:]))
+        feat = rng.rand(self.K, self.ctx_dim).astype('float32')
+        # a padded frame
+        feat[-1] = 0.
+        return feat
+
+    def caption_lengths(self, tags):
+        return numpy.asarray([2 + int(tag.split('_')[1]) for tag in tags])
+
+    def get_caption(self, tag):
+        return numpy.arange(2, 4 + int(tag.split('_')[1]), dtype='int32')
+
+
+def f_log_probs(x, mask, ctx, ctx_mask):
+    return -(ctx.sum(2).sum(1) + mask.sum(0)).astype('float32')
+
+
+def validate(engine):
+    rval = perplexity.pred_probs(engine, ['valid', 'test'], f_log_probs, verbose=False)
+    for whichset in ['valid', 'test']:
+        videos = engine.prepare_data_for_blue(whichset)
+        for i in range(len(videos)):
+            ctx, ctx_mask = videos[i]
+            assert ctx_mask.tolist() == [1., 1., 1., 0.]
+    return rval
+
+
+class TestEvalContexts(unittest.TestCase):
+    def test_read_once_across_validations(self):
+        engine = StubEngine()
+        first = validate(engine)
+        second = validate(engine)
+        self.assertEqual(first, second)
+        self.assertEqual(dict(engine.reads),
+                         dict((vidID, 1) for vidID in engine.valid_ids + engine.test_ids))
+
+    def test_bounded(self):
+        max_mb = data_engine.MAX_EVAL_CONTEXTS_MB
+        data_engine.MAX_EVAL_CONTEXTS_MB = 0
+        try:
+            engine = StubEngine()
+            first = validate(engine)
+            second = validate(engine)
+        finally:
+            data_engine.MAX_EVAL_CONTEXTS_MB = max_mb
+        self.assertEqual(first, second)
+        # the 3 captions of pred_probs and the decoding, at both validations
+        self.assertEqual(set(engine.reads.values()), set([8]))
+
+
+if __name__ == '__main__':
+    unittest.main()
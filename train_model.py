@@ -10,10 +10,22 @@ import copy
 import os, sys
 import time
 
+import attention_stats
 import data_engine
 import metrics
+import profiling
 import utils
-
+from attention_stats import AttentionStats, attention_outputs
+from checkpoint import CheckpointWriter, RESUME_FILE, save_resume, load_resume
+from function_cache import load_or_build
+from parallel import GradientAverager, Workers
+from prefetcher import BatchPrefetcher
+from training_log import TrainingLog
+from validation import AsyncValidator
+from samplers import BucketSampler, ShardedSampler, padding_efficiency
+from streaming_dataset import load_engine
+
+import optimizers
 from optimizers import adadelta, sgd
 from model_hLSTMat.layers import Layers
 from model_hLSTMat.model import Model
@@ -27,6 +39,87 @@ from config import config
 from jobman import DD, expand
 
 
+def build_functions(model, tparams, options):
+    '''
+    Compile the training, sampling and log-prob functions of model on
+    tparams. Returns them with the shared variables they use, the bundle
+    function_cache keeps on disk.
+    '''
+    decay_c = options['decay_c']
+    alpha_c = options['alpha_c']
+    alpha_entropy_r = options['alpha_entropy_r']
+    clip_c = options['clip_c']
+    optimizer = options['optimizer']
+    profile = options['profile']
+
+    trng, use_noise, \
+    x, mask, ctx, mask_ctx, \
+    cost, extra = \
+        model.build_model(tparams, options)
+    alphas = extra[1]
+    betas = extra[2]
+    print 'buliding sampler'
+    f_init, f_next = model.build_sampler(tparams, options, use_noise, trng,
+                                         profile=profile)
+    # before any regularizer
+    print 'building f_log_probs'
+    f_log_probs = theano.function([x, mask, ctx, mask_ctx], -cost,
+                                  profile=utils.profile_stats('f_log_probs', profile),
+                                  on_unused_input='ignore')
+
+    cost = cost.mean()
+    if decay_c > 0.:
+        decay_c = theano.shared(numpy.float32(decay_c), name='decay_c')
+        weight_decay = 0.
+        for kk, vv in tparams.iteritems():
+            weight_decay += (vv ** 2).sum()
+        weight_decay *= decay_c
+        cost += weight_decay
+
+    if alpha_c > 0.:
+        alpha_c = theano.shared(numpy.float32(alpha_c), name='alpha_c')
+        alpha_reg = alpha_c * ((1. - alphas.sum(0)) ** 2).sum(-1).mean()
+        cost += alpha_reg
+
+    if alpha_entropy_r > 0:
+        alpha_entropy_r = theano.shared(numpy.float32(alpha_entropy_r),
+                                        name='alpha_entropy_r')
+        alpha_reg_2 = alpha_entropy_r * (-tensor.sum(alphas *
+                                                     tensor.log(alphas + 1e-8), axis=-1)).sum(-1).mean()
+        cost += alpha_reg_2
+    else:
+        alpha_reg_2 = tensor.zeros_like(cost)
+    print 'compute grad'
+    grads = tensor.grad(cost, wrt=utils.itemlist(tparams))
+    if clip_c > 0.:
+        g2 = 0.
+        for g in grads:
+            g2 += (g ** 2).sum()
+        new_grads = []
+        for g in grads:
+            new_grads.append(tensor.switch(g2 > (clip_c ** 2),
+                                           g / tensor.sqrt(g2) * clip_c,
+                                           g))
+        grads = new_grads
+
+    lr = tensor.scalar(name='lr')
+    print 'build train fns'
+    print 'optimizer is ' + optimizer
+    # the update returns the attention statistics; probs, attention and
+    # every gradient are only copied back to the host in diagnostic mode
+    f_grad_shared, f_update, optimizer_state = eval(optimizer)(
+        lr, tparams, grads, [x, mask, ctx, mask_ctx], cost,
+        attention_outputs(alphas, betas, mask) +
+        (extra + grads if options['grad_diagnostics'] else []),
+        accum_steps=options['accum_steps'],
+        profile=profile)
+    return {'tparams': tparams, 'trng': trng, 'use_noise': use_noise,
+            'f_init': f_init, 'f_next': f_next, 'f_log_probs': f_log_probs,
+            'f_grad_shared': f_grad_shared,
+            'f_update': f_update, 'optimizer_state': optimizer_state,
+            'n_extra': len(extra)}
+
+
 def train(random_seed=1234,
           dim_word=256,  # word vector dimensionality
           ctx_dim=-1,  # context vector dimensionality, auto set
@@ -67,15 +160,38 @@ def train(random_seed=1234,
           verbose=True,
           debug=True,
           channel=512,
-          T=28, wh=49
+          T=28, wh=49,
+          feature_store=None,
+          feature_cache_mb=0,
+          dataset_manifest=None,
+          prefetch_depth=4,
+          prefetch_workers=2,
+          n_buckets=10,
+          rank=0,
+          world_size=1,
+          grad_diagnostics=False,
+          checkpoint_compress=False,
+          keep_checkpoints=3,
+          resume=False,
+          async_valid=False,
+          grad_sync=None,
+          accum_steps=1,
+          train_log='jsonl',
+          profile=False,
+          profile_memory=True,
+          profile_top_n=20,
+          function_cache=None
           ):
     rng_numpy, rng_theano = utils.get_two_rngs()
 
     model_options = locals().copy()
     if 'self' in model_options:
         del model_options['self']
-    with open('%smodel_options.pkl' % save_model_dir, 'wb') as f:
-        pkl.dump(model_options, f)
+    t_start = time.time()
+    # the workers of a data-parallel run share save_model_dir, rank 0 writes
+    if rank == 0:
+        with open('%smodel_options.pkl' % save_model_dir, 'wb') as f:
+            pkl.dump(model_options, f)
 
     # instance model
     layers = Layers()
@@ -84,23 +200,50 @@ def train(random_seed=1234,
     # model = NonLocalModel()
     model = LSTMNonLocalModel()
     print 'Loading data'
-    engine = data_engine.Movie2Caption('attention', dataset,
-                                       video_feature,
-                                       batch_size, valid_batch_size,
-                                       maxlen, n_words,
-                                       K, OutOf)
+    # sharded captions streamed with dataset_manifest, as the tools load it
+    engine = load_engine(model_options)
     model_options['ctx_dim'] = engine.ctx_dim
     model_options['n_words'] = engine.n_words
     model_options['twh'] = K
     model_options['channel'] = channel
     print 'n_words:', model_options['n_words']
 
+    validator = None
+    if async_valid and validFreq != -1:
+        # forked before any parameter or function of the training process
+        # exists on the device, builds its own graph on CPU
+        validator = AsyncValidator(model, model_options, engine, save_model_dir,
+                                   rank, world_size)
+
+    train_lengths = engine.caption_lengths(engine.train)
+    train_sampler = None
+    if n_buckets > 0 or world_size > 1:
+        # a single bucket is a plain shuffle
+        train_sampler = BucketSampler(train_lengths, batch_size, max(n_buckets, 1),
+                                      maxlen=maxlen, seed=random_seed)
+        if maxlen is not None:
+            print 'bucket sampler leaves out %d captions of length >= %d' % (
+                train_sampler.n_dropped, maxlen)
+        if world_size > 1:
+            train_sampler = ShardedSampler(train_sampler, rank, world_size,
+                                           seed=random_seed, even=bool(grad_sync))
+            print 'worker %d of %d' % (rank, world_size)
+        engine.kf_train = train_sampler.epoch_batches(0)
+
     # set test values, for debugging
     idx = engine.kf_train[0]
     [x_tv, mask_tv,
      ctx_tv, ctx_mask_tv] = data_engine.prepare_data(
         engine, [engine.train[index] for index in idx])
 
+    tlog = None
+    if train_log:
+        tlog = TrainingLog(save_model_dir, fmt=train_log,
+                           name='train_log' if world_size == 1 else 'train_log_rank%d' % rank)
+
+    if profile:
+        profiling.enable(memory=profile_memory)
+
     print 'init params'
     t0 = time.time()
     params = model.init_params(model_options)
@@ -114,71 +257,32 @@ def train(random_seed=1234,
 
     tparams = utils.init_tparams(params)
 
-    trng, use_noise, \
-    x, mask, ctx, mask_ctx, \
-    cost, extra = \
-        model.build_model(tparams, model_options)
-    alphas = extra[1]
-    betas = extra[2]
-    print 'buliding sampler'
-    f_init, f_next = model.build_sampler(tparams, model_options, use_noise, trng)
-    # before any regularizer
-    print 'building f_log_probs'
-    f_log_probs = theano.function([x, mask, ctx, mask_ctx], -cost,
-                                  profile=False, on_unused_input='ignore')
-
-    cost = cost.mean()
-    if decay_c > 0.:
-        decay_c = theano.shared(numpy.float32(decay_c), name='decay_c')
-        weight_decay = 0.
-        for kk, vv in tparams.iteritems():
-            weight_decay += (vv ** 2).sum()
-        weight_decay *= decay_c
-        cost += weight_decay
-
-    if alpha_c > 0.:
-        alpha_c = theano.shared(numpy.float32(alpha_c), name='alpha_c')
-        alpha_reg = alpha_c * ((1. - alphas.sum(0)) ** 2).sum(-1).mean()
-        cost += alpha_reg
-
-    if alpha_entropy_r > 0:
-        alpha_entropy_r = theano.shared(numpy.float32(alpha_entropy_r),
-                                        name='alpha_entropy_r')
-        alpha_reg_2 = alpha_entropy_r * (-tensor.sum(alphas *
-                                                     tensor.log(alphas + 1e-8), axis=-1)).sum(-1).mean()
-        cost += alpha_reg_2
-    else:
-        alpha_reg_2 = tensor.zeros_like(cost)
-    print 'building f_alpha'
-    f_alpha = theano.function([x, mask, ctx, mask_ctx],
-                              [alphas, betas],
-                              name='f_alpha',
-                              on_unused_input='ignore')
-
-    print 'compute grad'
-    grads = tensor.grad(cost, wrt=utils.itemlist(tparams))
-    if clip_c > 0.:
-        g2 = 0.
-        for g in grads:
-            g2 += (g ** 2).sum()
-        new_grads = []
-        for g in grads:
-            new_grads.append(tensor.switch(g2 > (clip_c ** 2),
-                                           g / tensor.sqrt(g2) * clip_c,
-                                           g))
-        grads = new_grads
-
-    lr = tensor.scalar(name='lr')
-    print 'build train fns'
-    print 'optimizer is ' + optimizer
-    if optimizer == 'adadelta':
-        f_grad_shared, f_update = eval(optimizer)(lr, tparams, grads,
-                                                  [x, mask, ctx, mask_ctx], cost,
-                                                  extra + grads)
-    else:
-        f_grad_shared, f_update = eval(optimizer)(lr, tparams, grads, [x, mask, ctx, mask_ctx], cost)
+    # profiling stats are not cached
+    bundle = load_or_build(function_cache if not profile else None, 'train',
+                           model, model_options,
+                           lambda: build_functions(model, tparams, model_options),
+                           sources=[optimizers.__file__, utils.__file__,
+                                    attention_stats.__file__, __file__])
+    # the parameters of a cached bundle are those it was saved with
+    tparams = bundle['tparams']
+    utils.zipp(params, tparams)
+    trng = bundle['trng']
+    use_noise = bundle['use_noise']
+    f_init = bundle['f_init']
+    f_next = bundle['f_next']
+    f_log_probs = bundle['f_log_probs']
+    f_grad_shared = bundle['f_grad_shared']
+    f_update = bundle['f_update']
+    optimizer_state = bundle['optimizer_state']
+    n_extra = bundle['n_extra']
     print 'compilation took %.4f sec' % (time.time() - t0)
+    if tlog is not None:
+        tlog.phase('compile', time.time() - t0)
     print 'Optimization'
+    profiled = None
+    if profile:
+        profiled = [f_grad_shared, f_update, f_init, f_next, f_log_probs]
+        profile_suffix = '' if world_size == 1 else '_rank%d' % rank
 
     history_errs = []
     # reload history
@@ -188,6 +292,13 @@ def train(random_seed=1234,
             from_dir + 'model_best_so_far.npz')['history_errs'].tolist()
 
     bad_counter = 0
+    attention = AttentionStats()
+    resume_path = os.path.join(save_model_dir, RESUME_FILE)
+    resuming = resume and os.path.isfile(resume_path)
+    # a resumed run rotates out the checkpoints of the run it goes on from
+    checkpoints = CheckpointWriter(save_model_dir, compress=checkpoint_compress,
+                                   keep_last=keep_checkpoints, enabled=rank == 0,
+                                   log=tlog, adopt=resuming)
 
     processes = None
     queue = None
@@ -202,47 +313,128 @@ def train(random_seed=1234,
     best_blue_valid = 0
     best_valid_err = 999
     alphas_ratio = []
-    for eidx in xrange(max_epochs):
-        n_samples = 0
-        train_costs = []
+    train_error = 0.
+    start_eidx = 0
+    # minibatches of the current epoch already trained on
+    bidx = 0
+    # micro-batches in the gradient buffers, carried over to the next epoch
+    n_micro = 0
+    # samples and costs of the current epoch so far
+    n_samples = 0
+    train_costs = []
+    if resuming:
+        print 'resuming from %s' % resume_path
+        loop_state = load_resume(resume_path, tparams, optimizer_state, trng)
+        uidx = loop_state['uidx']
+        start_eidx = loop_state['eidx']
+        bidx = loop_state['bidx']
+        bad_counter = loop_state['bad_counter']
+        history_errs = loop_state['history_errs']
+        best_valid_err = loop_state['best_valid_err']
+        uidx_best_valid_err = loop_state['uidx_best_valid_err']
+        alphas_ratio = loop_state['alphas_ratio']
+        train_error = loop_state['train_error']
+        n_samples = loop_state.get('n_samples', 0)
+        train_costs = loop_state.get('train_costs', [])
+        best_p = utils.unzip(tparams)
+        if os.path.isfile(save_model_dir + 'model_best_so_far.npz'):
+            best_p = utils.load_params(save_model_dir + 'model_best_so_far.npz', best_p)
+        print 'epoch %d, minibatch %d of the epoch, update %d' % (start_eidx, bidx, uidx)
+
+    averager = None
+    workers = None
+    if grad_sync:
+        # the gradient buffers come first in optimizer_state
+        averager = GradientAverager(grad_sync, rank, world_size,
+                                    optimizer_state[:len(tparams)])
+        # the workers share the costs of the valid and test sets
+        workers = Workers(save_model_dir, grad_sync, rank, world_size)
+
+    def _loop_state():
+        return {'uidx': uidx, 'eidx': eidx, 'bidx': bidx,
+                'bad_counter': bad_counter, 'history_errs': history_errs,
+                'best_valid_err': best_valid_err,
+                'uidx_best_valid_err': uidx_best_valid_err,
+                'alphas_ratio': alphas_ratio, 'train_error': train_error,
+                'n_samples': n_samples, 'train_costs': train_costs}
+
+    for eidx in xrange(start_eidx, max_epochs):
         grads_record = []
         print 'Epoch ', eidx
-        for idx in engine.kf_train:
-            tags = [engine.train[index] for index in idx]
+        if train_sampler is not None:
+            engine.kf_train = train_sampler.epoch_batches(eidx)
+        print 'padding efficiency %.3f' % padding_efficiency(
+            train_lengths, engine.kf_train)
+        # the epoch is rebuilt from its seed, a resumed one skips the
+        # minibatches it has already seen
+        prefetcher = BatchPrefetcher(
+            engine, [[engine.train[index] for index in idx]
+                     for idx in engine.kf_train[bidx:]],
+            depth=prefetch_depth, n_workers=prefetch_workers)
+        for tags, (x, mask, ctx, ctx_mask) in prefetcher:
             n_samples += len(tags)
-            uidx += 1
+            bidx += 1
             use_noise.set_value(1.)
 
-            pd_start = time.time()
-            x, mask, ctx, ctx_mask = data_engine.prepare_data(
-                engine, tags)
-            pd_duration = time.time() - pd_start
+            # time spent waiting on the prefetch queue
+            pd_duration = prefetcher.wait_time
             if x is None:
                 print 'Minibatch with zero sample under length ', maxlen
                 continue
 
+            if n_micro == 0:
+                accum_costs = []
+                ud_duration = 0.
+                data_wait = 0.
+                step_samples = 0
+                step_tokens = 0
+            data_wait += pd_duration
+            step_samples += x.shape[1]
+            step_tokens += mask.sum()
             ud_start = time.time()
             rvals = f_grad_shared(x, mask, ctx, ctx_mask)
             cost = rvals[0]
-            probs = rvals[1]
-            alphas = rvals[2]
-            betas = rvals[3]
-            grads = rvals[4:]
-            grads, NaN_keys = utils.grad_nan_report(grads, tparams)
-            if len(grads_record) >= 5:
-                del grads_record[0]
-            grads_record.append(grads)
-            if NaN_keys != []:
-                print 'grads contain NaN'
-                import pdb;
-                pdb.set_trace()
-            if numpy.isnan(cost) or numpy.isinf(cost):
-                print 'NaN detected in cost'
+            finite = rvals[1]
+            alpha_ratio, betas_mean, betas_0 = rvals[2:5]
+            attention.update(alpha_ratio, betas_mean)
+            if grad_diagnostics:
+                probs, alphas, betas = rvals[5:5 + n_extra]
+                grads = rvals[5 + n_extra:]
+                grads, NaN_keys = utils.grad_nan_report(grads, tparams)
+                if len(grads_record) >= 5:
+                    del grads_record[0]
+                grads_record.append(grads)
+                if NaN_keys != []:
+                    print 'grads contain NaN', NaN_keys
+            if not finite:
+                print 'NaN detected in cost or grads'
+                if averager is not None:
+                    # the others would wait for this worker's gradients
+                    averager.stop()
+                    raise FloatingPointError('NaN in cost or grads at update %d' % uidx)
                 import pdb;
                 pdb.set_trace()
+            # the gradients of accum_steps micro-batches make one update
+            accum_costs.append(cost)
+            n_micro += 1
+            if n_micro < accum_steps:
+                ud_duration += time.time() - ud_start
+                continue
+            n_micro = 0
+            cost = numpy.mean(accum_costs)
+            if averager is not None and not averager.average():
+                print 'another worker has stopped'
+                estop = True
+                break
             # update params
             f_update(lrate)
-            ud_duration = time.time() - ud_start
+            ud_duration += time.time() - ud_start
+            uidx += 1
+            if tlog is not None:
+                tlog.step(eidx, uidx, step_samples, step_tokens, data_wait, ud_duration)
+            if t_start is not None:
+                print 'time to first update %.2f sec' % (time.time() - t_start)
+                t_start = None
 
             if eidx == 0:
                 train_error = cost
@@ -254,25 +446,25 @@ def train(random_seed=1234,
                 print 'Epoch ', eidx, 'Update ', uidx, 'Train cost mean so far', \
                     train_error, 'fetching data time spent (sec)', pd_duration, \
                     'update time spent (sec)', ud_duration, 'save_dir', save_model_dir
-                alphas, betas = f_alpha(x, mask, ctx, ctx_mask)
-                counts = mask.sum(0)
-                betas_mean = (betas * mask).sum(0) / counts
-                betas_mean = betas_mean.mean()
-                print 'alpha ratio %.3f, betas mean %.3f' % (
-                    alphas.min(-1).mean() / (alphas.max(-1)).mean(), betas_mean)
+                if engine.feature_cache is not None:
+                    print engine.feature_cache.stats()
+                if tlog is not None:
+                    print tlog.report(uidx)
+                print 'alpha ratio %.3f, betas mean %.3f since the last display' % \
+                    attention.report('display')
                 l = 0
                 for vv in x[:, 0]:
                     if vv == 0:
                         break
                     if vv in engine.word_idict:
-                        print '(', numpy.round(betas[l, 0], 3), ')', engine.word_idict[vv],
+                        print '(', numpy.round(betas_0[l], 3), ')', engine.word_idict[vv],
                     else:
-                        print '(', numpy.round(betas[l, 0], 3), ')', 'UNK',
+                        print '(', numpy.round(betas_0[l], 3), ')', 'UNK',
                     l += 1
-                print '(', numpy.round(betas[l, 0], 3), ')'
+                print '(', numpy.round(betas_0[l], 3), ')'
 
-            if numpy.mod(uidx, saveFreq) == 0:
-                pass
+            if saveFreq != -1 and numpy.mod(uidx, saveFreq) == 0:
+                save_resume(checkpoints, tparams, optimizer_state, trng, _loop_state())
 
             if numpy.mod(uidx, sampleFreq) == 0:
                 use_noise.set_value(0.)
@@ -290,82 +482,91 @@ def train(random_seed=1234,
                 model.sample_execute(engine, model_options, tparams,
                                      f_init, f_next, x_s, ctx_s, mask_ctx_s, trng)
 
+            valid_results = []
             if validFreq != -1 and numpy.mod(uidx, validFreq) == 0:
                 t0_valid = time.time()
-                alphas, _ = f_alpha(x, mask, ctx, ctx_mask)
-                ratio = alphas.min(-1).mean() / (alphas.max(-1)).mean()
+                ratio, _ = attention.report('valid')
                 alphas_ratio.append(ratio)
-                numpy.savetxt(save_model_dir + 'alpha_ratio.txt', alphas_ratio)
+                if rank == 0:
+                    numpy.savetxt(save_model_dir + 'alpha_ratio.txt', alphas_ratio)
 
                 current_params = utils.unzip(tparams)
-                numpy.savez(
-                    save_model_dir + 'model_current.npz',
-                    history_errs=history_errs, **current_params)
 
-                use_noise.set_value(0.)
-                train_err = -1
-                train_perp = -1
-                valid_err = -1
-                valid_perp = -1
-                test_err = -1
-                test_perp = -1
-                if not debug:
-                    # first compute train cost
-                    if 0:
-                        print 'computing cost on trainset'
-                        train_err, train_perp = model.pred_probs(
-                            engine, 'train', f_log_probs,
-                            verbose=model_options['verbose'])
-                    else:
-                        train_err = 0.
-                        train_perp = 0.
-                    if 1:
-                        print 'validating...'
-                        valid_err, valid_perp = model.pred_probs(
-                            engine, 'valid', f_log_probs,
+                if validator is not None:
+                    # costs and scores come back through validator.poll()
+                    train_err = 0.
+                    train_perp = 0.
+                    valid_results = validator.submit(eidx, uidx, current_params)
+                    if tlog is not None:
+                        tlog.phase('valid_submit', time.time() - t0_valid, uidx)
+                else:
+                    use_noise.set_value(0.)
+                    train_err = -1
+                    train_perp = -1
+                    valid_err = -1
+                    valid_perp = -1
+                    test_err = -1
+                    test_perp = -1
+                    probs_t0 = time.time()
+                    if not debug:
+                        # first compute train cost
+                        if 0:
+                            print 'computing cost on trainset'
+                            train_err, train_perp = model.pred_probs(
+                                engine, 'train', f_log_probs,
+                                verbose=model_options['verbose'])
+                        else:
+                            train_err = 0.
+                            train_perp = 0.
+                        print 'validating and testing...'
+                        (valid_err, valid_perp), (test_err, test_perp) = model.pred_probs(
+                            engine, ['valid', 'test'], f_log_probs,
                             verbose=model_options['verbose'],
+                            workers=workers, key=uidx)
+
+                    if tlog is not None:
+                        tlog.phase('valid_probs', time.time() - probs_t0, uidx)
+                    mean_ranking = 0
+                    blue_t0 = time.time()
+                    scores, processes, queue, rqueue, shared_params = \
+                        metrics.compute_score(
+                            model_type='attention',
+                            model_archive=current_params,
+                            options=model_options,
+                            engine=engine,
+                            save_dir=save_model_dir,
+                            beam=5, n_process=5,
+                            whichset='both',
+                            on_cpu=False,
+                            processes=processes, queue=queue, rqueue=rqueue,
+                            shared_params=shared_params, metric=metric,
+                            one_time=False,
+                            f_init=f_init, f_next=f_next, model=model,
+                            rank=rank, world_size=world_size, uidx=uidx
                         )
-                    else:
-                        valid_err = 0.
-                        valid_perp = 0.
-                    if 1:
-                        print 'testing...'
-                        test_err, test_perp = model.pred_probs(
-                            engine, 'test', f_log_probs,
-                            verbose=model_options['verbose']
-                        )
-                    else:
-                        test_err = 0.
-                        test_perp = 0.
-
-                mean_ranking = 0
-                blue_t0 = time.time()
-                scores, processes, queue, rqueue, shared_params = \
-                    metrics.compute_score(
-                        model_type='attention',
-                        model_archive=current_params,
-                        options=model_options,
-                        engine=engine,
-                        save_dir=save_model_dir,
-                        beam=5, n_process=5,
-                        whichset='both',
-                        on_cpu=False,
-                        processes=processes, queue=queue, rqueue=rqueue,
-                        shared_params=shared_params, metric=metric,
-                        one_time=False,
-                        f_init=f_init, f_next=f_next, model=model
-                    )
-                '''
-                 {'blue': {'test': [-1], 'valid': [77.7, 60.5, 48.7, 38.5, 38.3]},
-                 'alternative_valid': {'Bleu_3': 0.40702270203174923,
-                 'Bleu_4': 0.29276570520368456,
-                 'CIDEr': 0.25247168210607884,
-                 'Bleu_2': 0.529069629270047,
-                 'Bleu_1': 0.6804308797115253,
-                 'ROUGE_L': 0.51083584331688392},
-                 'meteor': {'test': [-1], 'valid': [0.282787550236724]}}
-                '''
-
+                    print 'computing meteor/blue score used %.4f sec' % (time.time() - blue_t0)
+                    if tlog is not None:
+                        tlog.phase('valid_scores', time.time() - blue_t0, uidx)
+                    '''
+                     {'blue': {'test': [-1], 'valid': [77.7, 60.5, 48.7, 38.5, 38.3]},
+                     'alternative_valid': {'Bleu_3': 0.40702270203174923,
+                     'Bleu_4': 0.29276570520368456,
+                     'CIDEr': 0.25247168210607884,
+                     'Bleu_2': 0.529069629270047,
+                     'Bleu_1': 0.6804308797115253,
+                     'ROUGE_L': 0.51083584331688392},
+                     'meteor': {'test': [-1], 'valid': [0.282787550236724]}}
+                    '''
+                    valid_results = [(eidx, uidx, current_params, valid_err, valid_perp,
+                                      test_err, test_perp, scores,
+                                      t0_valid, time.time() - t0_valid)]
+                if profiled is not None:
+                    profiling.report(profiled, save_model_dir, profile_top_n,
+                                     profile_suffix)
+            elif validator is not None:
+                valid_results = validator.poll()
+            for (v_eidx, v_uidx, v_params, valid_err, valid_perp,
+                 test_err, test_perp, scores, v_submitted, v_seconds) in valid_results:
                 valid_B1 = scores['valid']['Bleu_1']
                 valid_B2 = scores['valid']['Bleu_2']
                 valid_B3 = scores['valid']['Bleu_3']
@@ -380,40 +581,43 @@ def train(random_seed=1234,
                 test_Rouge = scores['test']['ROUGE_L']
                 test_Cider = scores['test']['CIDEr']
                 test_meteor = scores['test']['METEOR']
-                print 'computing meteor/blue score used %.4f sec, ' \
-                      'blue score: %.1f, meteor score: %.1f' % (
-                          time.time() - blue_t0, valid_B4, valid_meteor)
-                history_errs.append([eidx, uidx, train_err, train_perp,
+                print 'blue score: %.1f, meteor score: %.1f' % (valid_B4, valid_meteor)
+                history_errs.append([v_eidx, v_uidx, train_err, train_perp,
                                      valid_perp, test_perp,
                                      valid_err, test_err,
                                      valid_B1, valid_B2, valid_B3,
                                      valid_B4, valid_meteor, valid_Rouge, valid_Cider,
                                      test_B1, test_B2, test_B3,
                                      test_B4, test_meteor, test_Rouge, test_Cider])
-                numpy.savetxt(save_model_dir + 'train_valid_test.txt',
-                              history_errs, fmt='%.3f')
+                if rank == 0:
+                    numpy.savetxt(save_model_dir + 'train_valid_test.txt',
+                                  history_errs, fmt='%.3f')
                 print 'save validation results to %s' % save_model_dir
+                # the last keep_checkpoints of these are kept, and the good ones
+                checkpoints.save('model_%d.npz' % v_uidx, v_params,
+                                 rotate=True, pin=test_B4 > 0.52 and test_meteor > 0.32,
+                                 aliases=['model_current.npz'],
+                                 history_errs=history_errs)
                 # save best model according to the best blue or meteor
                 if len(history_errs) > 1 and \
                                 valid_B4 > numpy.array(history_errs)[:-1, 11].max():
-                    best_p = utils.unzip(tparams)
+                    best_p = v_params
                     print 'Saving to %s...' % save_model_dir,
-                    numpy.savez(
-                        save_model_dir + 'model_best_blue_or_meteor.npz',
-                        history_errs=history_errs, **best_p)
+                    checkpoints.save('model_best_blue_or_meteor.npz', best_p,
+                                     history_errs=history_errs)
                 if len(history_errs) > 1 and \
                                 valid_err < numpy.array(history_errs)[:-1, 6].min():
-                    best_p = utils.unzip(tparams)
+                    best_p = v_params
                     bad_counter = 0
                     best_valid_err = valid_err
-                    uidx_best_valid_err = uidx
+                    uidx_best_valid_err = v_uidx
 
                     print 'Saving to %s...' % save_model_dir,
-                    numpy.savez(
-                        save_model_dir + 'model_best_so_far.npz',
-                        history_errs=history_errs, **best_p)
-                    with open('%smodel_options.pkl' % save_model_dir, 'wb') as f:
-                        pkl.dump(model_options, f)
+                    checkpoints.save('model_best_so_far.npz', best_p,
+                                     history_errs=history_errs)
+                    if rank == 0:
+                        with open('%smodel_options.pkl' % save_model_dir, 'wb') as f:
+                            pkl.dump(model_options, f)
                     print 'Done'
                 elif len(history_errs) > 1 and \
                                 valid_err >= numpy.array(history_errs)[:-1, 6].min():
@@ -426,18 +630,22 @@ def train(random_seed=1234,
                         estop = True
                         break
 
-                if test_B4 > 0.52 and test_meteor > 0.32:
-                    print 'Saving to %s...' % save_model_dir,
-                    numpy.savez(
-                        save_model_dir + 'model_' + str(uidx) + '.npz',
-                        history_errs=history_errs, **current_params)
-
+                save_resume(checkpoints, tparams, optimizer_state, trng, _loop_state())
                 print 'Train ', train_err, 'Valid ', valid_err, 'Test ', test_err, \
                     'best valid err so far', best_valid_err
-                print 'valid took %.2f sec' % (time.time() - t0_valid)
+                # with async_valid, the results of an earlier snapshot
+                print 'valid of update %d took %.2f sec, results %.2f sec after the submission' % (
+                    v_uidx, v_seconds, time.time() - v_submitted)
+                if tlog is not None:
+                    tlog.phase('valid', v_seconds, v_uidx)
                 # end of validatioin
+            if estop:
+                break
             if debug:
                 break
+        # stop the workers also when leaving the epoch early
+        prefetcher.close()
+        bidx = 0
         if estop:
             break
         if debug:
@@ -446,7 +654,25 @@ def train(random_seed=1234,
         # end for loop over minibatches
         print 'This epoch has seen %d samples, train cost %.2f' % (
             n_samples, numpy.mean(train_costs))
+        n_samples = 0
+        train_costs = []
     # end for loop over epochs
+    if averager is not None:
+        averager.stop()
+    if validator is not None:
+        # the snapshot still being validated is recorded, it can no
+        # longer stop the training
+        for (v_eidx, v_uidx, v_params, valid_err, valid_perp,
+             test_err, test_perp, scores, _, _) in validator.close():
+            history_errs.append(
+                [v_eidx, v_uidx, 0., 0., valid_perp, test_perp, valid_err, test_err] +
+                [scores[whichset][k] for whichset in ['valid', 'test']
+                 for k in ['Bleu_1', 'Bleu_2', 'Bleu_3', 'Bleu_4', 'METEOR', 'ROUGE_L', 'CIDEr']])
+            if valid_err < best_valid_err:
+                best_valid_err = valid_err
+                best_p = v_params
+                checkpoints.save('model_best_so_far.npz', best_p,
+                                 history_errs=history_errs)
     print 'Optimization ended.'
     if best_p is not None:
         utils.zipp(best_p, tparams)
@@ -457,29 +683,32 @@ def train(random_seed=1234,
     if not debug:
         train_err, train_perp = model.pred_probs(
             engine, 'train', f_log_probs,
-            verbose=model_options['verbose'])
-        # if valid:
-        valid_err, valid_perp = model.pred_probs(
-            engine, 'valid', f_log_probs,
-            verbose=model_options['verbose'])
-        # if test:
-        test_err, test_perp = model.pred_probs(
-            'test', f_log_probs,
-            verbose=model_options['verbose'])
+            verbose=model_options['verbose'],
+            workers=workers, key='end')
+        (valid_err, valid_perp), (test_err, test_perp) = model.pred_probs(
+            engine, ['valid', 'test'], f_log_probs,
+            verbose=model_options['verbose'],
+            workers=workers, key='end')
 
     print 'stopped at epoch %d, minibatch %d, ' \
           'curent Train %.2f, current Valid %.2f, current Test %.2f ' % (
               eidx, uidx, numpy.mean(train_err), numpy.mean(valid_err), numpy.mean(test_err))
     params = copy.copy(best_p)
-    numpy.savez(save_model_dir + 'model_best.npz',
-                train_err=train_err,
-                valid_err=valid_err, test_err=test_err, history_errs=history_errs,
-                **params)
+    checkpoints.save('model_best.npz', params,
+                     train_err=train_err,
+                     valid_err=valid_err, test_err=test_err, history_errs=history_errs)
+    checkpoints.close()
+    if tlog is not None:
+        print tlog.report(uidx)
+        tlog.close()
+    if profiled is not None:
+        profiling.report(profiled, save_model_dir, profile_top_n, profile_suffix)
 
     if history_errs != []:
         history = numpy.asarray(history_errs)
         best_valid_idx = history[:, 6].argmin()
-        numpy.savetxt(save_model_dir + 'train_valid_test.txt', history, fmt='%.4f')
+        if rank == 0:
+            numpy.savetxt(save_model_dir + 'train_valid_test.txt', history, fmt='%.4f')
         print 'final best exp ', history[best_valid_idx]
 
     return train_err, valid_err, test_err
@@ -514,7 +743,9 @@ def train_from_scratch(config, state, channel):
         config[config.model].save_model_dir = save_dir_backup
         config[config.model].from_dir = from_dir_backup
         config[config.model].reload_ = True
-    if config.erase_history:
+    resuming = config[config.model].resume and \
+        os.path.isfile(os.path.join(save_model_dir, RESUME_FILE))
+    if config.erase_history and not resuming:
         print 'erasing everything in ', save_model_dir
         os.system('rm %s/*' % save_model_dir)
     # for stdout file logging
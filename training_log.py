@@ -0,0 +1,249 @@
+'''
+Structured log of a training run, next to the printed one: a record per
+update (samples/sec, tokens/sec, data wait, update time) and a record per
+phase (compilation, validation, checkpoints), appended to
+save_model_dir/train_log.jsonl, or as CSV to one train_log_<kind>.csv per
+kind of record. Files are rotated past max_mb. Rolling percentiles of the
+update records are logged at every report(), so that the throughput of
+runs can be compared without reading their logs:
+
+usage: python training_log.py run_dir [run_dir ...]
+
+The workers of a data-parallel run write train_log_rank<r>, summarized
+together.
+'''
+import csv
+import glob
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy
+
+FORMATS = ['jsonl', 'csv']
+STEP_FIELDS = ['samples_per_sec', 'tokens_per_sec', 'data_wait', 'update_time']
+PERCENTILES = [50, 90, 99]
+
+
+def _plain(v):
+    # numpy scalars are not JSON serializable
+    if isinstance(v, numpy.generic):
+        return v.item()
+    return v
+
+
+class TrainingLog(object):
+    def __init__(self, save_dir, fmt='jsonl', name='train_log', max_mb=64,
+                 keep=3, window=1000):
+        '''
+        max_mb: a file is rotated to <file>.1, <file>.2, ... past this
+                size, keep of the rotated files are kept.
+        window: updates over which the rolling percentiles are taken.
+        Thread-safe, the checkpoint writer logs from its own thread.
+        '''
+        assert fmt in FORMATS, fmt
+        self.save_dir = save_dir
+        self.fmt = fmt
+        self.name = name
+        self.max_bytes = max_mb * 2 ** 20
+        self.keep = keep
+        self.windows = OrderedDict((k, deque(maxlen=window)) for k in STEP_FIELDS)
+        # path -> (file, csv columns)
+        self._files = {}
+        self._lock = threading.Lock()
+        self.t_start = time.time()
+
+    def _path(self, kind):
+        if self.fmt == 'jsonl':
+            return os.path.join(self.save_dir, self.name + '.jsonl')
+        return os.path.join(self.save_dir, '%s_%s.csv' % (self.name, kind))
+
+    def _rotate(self, path):
+        for i in range(self.keep - 1, 0, -1):
+            if os.path.isfile('%s.%d' % (path, i)):
+                os.rename('%s.%d' % (path, i), '%s.%d' % (path, i + 1))
+        if self.keep > 0:
+            os.rename(path, path + '.1')
+        else:
+            os.remove(path)
+
+    def _open(self, path, record):
+        columns = None
+        if self.fmt == 'csv':
+            if os.path.isfile(path) and os.path.getsize(path) > 0:
+                # appending after a resume, keep the columns of the file
+                with open(path) as f:
+                    columns = next(csv.reader(f))
+            else:
+                columns = record.keys()
+                with open(path, 'w') as f:
+                    csv.writer(f).writerow(columns)
+        return open(path, 'a'), columns
+
+    def log(self, kind, **fields):
+        record = OrderedDict([('time', round(time.time() - self.t_start, 3)),
+                              ('kind', kind)])
+        for k in sorted(fields):
+            record[k] = _plain(fields[k])
+        path = self._path(kind)
+        with self._lock:
+            f, columns = self._files.get(path, (None, None))
+            if f is not None and f.tell() > self.max_bytes:
+                f.close()
+                self._rotate(path)
+                f = None
+            if f is None:
+                f, columns = self._open(path, record)
+                self._files[path] = (f, columns)
+            if self.fmt == 'jsonl':
+                f.write(json.dumps(record) + '\n')
+            else:
+                csv.writer(f).writerow([record.get(k, '') for k in columns])
+
+    def step(self, eidx, uidx, n_samples, n_tokens, data_wait, update_time):
+        # throughput of the update itself, validation and sampling excluded
+        seconds = max(data_wait + update_time, 1e-6)
+        values = {'samples_per_sec': n_samples / seconds,
+                  'tokens_per_sec': n_tokens / seconds,
+                  'data_wait': data_wait, 'update_time': update_time}
+        for k, window in self.windows.iteritems():
+            window.append(values[k])
+        self.log('step', eidx=eidx, uidx=uidx, samples=n_samples,
+                 tokens=n_tokens, **values)
+
+    def phase(self, name, seconds, uidx=-1, detail=''):
+        # the same fields for every phase, they share the CSV columns
+        self.log('phase', name=name, seconds=seconds, uidx=uidx, detail=detail)
+
+    def percentiles(self):
+        rval = OrderedDict()
+        for k, window in self.windows.iteritems():
+            if len(window) == 0:
+                continue
+            for p, v in zip(PERCENTILES, numpy.percentile(window, PERCENTILES)):
+                rval['%s_p%d' % (k, p)] = v
+        return rval
+
+    def report(self, uidx):
+        # logs the rolling percentiles and returns them as a line to print
+        rval = self.percentiles()
+        self.log('percentiles', uidx=uidx, window=len(self.windows['update_time']), **rval)
+        self.flush()
+        return ' '.join('%s %.3f' % (k, v) for k, v in rval.iteritems())
+
+    def flush(self):
+        with self._lock:
+            for f, _ in self._files.itervalues():
+                f.flush()
+
+    def close(self):
+        with self._lock:
+            for f, _ in self._files.itervalues():
+                f.close()
+            self._files = {}
+
+
+def read_records(run_dir, kind, name='train_log'):
+    # records of one kind, oldest rotated file first
+    jsonl = os.path.join(run_dir, name + '.jsonl')
+    fmt, path = ('jsonl', jsonl) if os.path.isfile(jsonl) else \
+        ('csv', os.path.join(run_dir, '%s_%s.csv' % (name, kind)))
+    rotated = [p for p in glob.glob(path + '.*') if p.rsplit('.', 1)[1].isdigit()]
+    paths = sorted(rotated, key=lambda p: -int(p.rsplit('.', 1)[1]))
+    if os.path.isfile(path):
+        paths.append(path)
+    records = []
+    for path in paths:
+        with open(path) as f:
+            if fmt == 'jsonl':
+                records += [r for r in (json.loads(line) for line in f)
+                            if r['kind'] == kind]
+            else:
+                records += [dict((k, _number(v)) for k, v in r.iteritems())
+                            for r in csv.DictReader(f)]
+    return records
+
+
+def _number(v):
+    try:
+        return float(v)
+    except ValueError:
+        return v
+
+
+def log_names(run_dir):
+    # train_log, or the train_log_rank<r> of every worker
+    names = set()
+    for path in glob.glob(os.path.join(run_dir, 'train_log*')):
+        m = re.match(r'(train_log(?:_rank\d+)?)(?:\.jsonl|_(?:step|phase|percentiles)\.csv)',
+                     os.path.basename(path))
+        if m is not None:
+            names.add(m.group(1))
+    return sorted(names, key=lambda name: int(name[14:] or -1))
+
+
+def summarize(run_dir, name=None):
+    '''
+    Percentiles of the update records of the whole run and the total
+    seconds of every phase. name: the log of one worker, e.g.
+    train_log_rank1; None merges the logs of all of them, the
+    percentiles over the updates of every worker and the phases of the
+    worker that spent the longest in them.
+    '''
+    names = [name] if name is not None else log_names(run_dir) or ['train_log']
+    steps = []
+    for name in names:
+        steps += read_records(run_dir, 'step', name)
+    rval = OrderedDict()
+    for k in STEP_FIELDS:
+        values = [r[k] for r in steps]
+        if values:
+            for p, v in zip(PERCENTILES, numpy.percentile(values, PERCENTILES)):
+                rval['%s_p%d' % (k, p)] = v
+    rval['updates'] = len(steps) / len(names)
+    if len(names) > 1:
+        rval['workers'] = len(names)
+    phases = OrderedDict()
+    for name in names:
+        seconds = {}
+        for r in read_records(run_dir, 'phase', name):
+            key = '%s_sec' % r['name']
+            seconds[key] = seconds.get(key, 0.) + r['seconds']
+            phases.setdefault(key, 0.)
+        for key, v in seconds.iteritems():
+            phases[key] = max(phases[key], v)
+    rval.update(phases)
+    return rval
+
+
+def main():
+    run_dirs = sys.argv[1:]
+    if not run_dirs:
+        print __doc__
+        exit(1)
+    summaries = [summarize(run_dir) for run_dir in run_dirs]
+    keys = []
+    for s in summaries:
+        keys += [k for k in s if k not in keys]
+    print '%-26s' % '' + ''.join('%22s' % os.path.basename(os.path.normpath(d))[-22:]
+                                 for d in run_dirs)
+    for k in keys:
+        ref = summaries[0].get(k)
+        row = '%-26s' % k
+        for s in summaries:
+            v = s.get(k)
+            if v is None:
+                row += '%22s' % '-'
+            elif ref and s is not summaries[0]:
+                row += '%14.3f (%5.2fx)' % (v, v / ref)
+            else:
+                row += '%22.3f' % v
+        print row
+
+
+if __name__ == '__main__':
+    main()
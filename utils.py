@@ -5,6 +5,7 @@ from collections import OrderedDict
 import theano
 import theano.tensor as tensor
 from theano.sandbox.rng_mrg import MRG_RandomStreams
+from theano.compile.profiling import ProfileStats
 from jobman import DD
 
 def get_two_rngs(seed=None):
@@ -134,6 +135,13 @@ def linear(x):
     return x
 
 
+# profile= of theano.function: the stats of a profiled function are kept in
+# f.profile and written by profiling.dump_profiles instead of at exit
+def profile_stats(name, enabled):
+    if not enabled:
+        return False
+    return ProfileStats(atexit_print=False, message=name)
+
 # make prefix-appended name
 def _p(pp, name):
     return '%s_%s'%(pp, name)
@@ -194,6 +202,56 @@ def dump_pkl(obj, path):
         f.close()
 
 
+class IndexedPickle(object):
+    """
+    Read-only dict kept on disk: every value is pickled separately into one
+    data file and a small pickled {key: (offset, size)} index lets a lookup
+    read and unpickle only that value.
+    """
+    def __init__(self, path):
+        self.path = path
+        meta = load_pkl(path + '.idx')
+        self.source_mtime = meta['source_mtime']
+        self.index = meta['index']
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def __getitem__(self, key):
+        offset, size = self.index[key]
+        # a file per read keeps lookups from several threads independent
+        f = open(self.path + '.dat', 'rb')
+        try:
+            f.seek(offset)
+            rval = cPickle.loads(f.read(size))
+        finally:
+            f.close()
+        return rval
+
+
+def dump_indexed_pkl(d, path, source_mtime=None):
+    """
+    Save a dict so that it can be opened with IndexedPickle.
+    """
+    index = {}
+    f = open(path + '.dat', 'wb')
+    try:
+        for k, v in d.iteritems():
+            s = cPickle.dumps(v, protocol=cPickle.HIGHEST_PROTOCOL)
+            index[k] = (f.tell(), len(s))
+            f.write(s)
+    finally:
+        f.close()
+    # the index goes last, data without it is never opened
+    dump_pkl({'index': index, 'source_mtime': source_mtime}, path + '.idx')
+
+
 def generate_minibatch_idx(dataset_size, minibatch_size):
     # generate idx for minibatches SGD
     # output [m1, m2, m3, ..., mk] where mk is a list of indices
@@ -0,0 +1,75 @@
+'''
+Validation in a separate process: train() hands a parameter snapshot to
+metrics.validate_model and goes on training; the costs and scores come
+back a few hundred updates later and are fed to the early stopping and
+best-model logic then. The process is forked before train() puts anything
+on the device, it never touches the CUDA context of the training.
+'''
+import time
+from multiprocessing import Process, Queue
+from Queue import Empty
+
+import metrics
+
+
+class AsyncValidator(object):
+    def __init__(self, model, options, engine, save_dir, rank=0, world_size=1):
+        self.queue = Queue()
+        self.rqueue = Queue()
+        self.shared_params = metrics.manager.dict()
+        self.shared_params['id'] = 0
+        # (eidx, uidx, params, submit time) of the snapshot being validated
+        self.pending = None
+        self.process = Process(target=metrics.validate_model,
+                               args=(self.queue, self.rqueue, model, options,
+                                     engine, save_dir, self.shared_params,
+                                     rank, world_size),
+                               name='validate')
+        self.process.daemon = True
+        self.process.start()
+
+    def submit(self, eidx, uidx, params):
+        '''
+        Validate params in the background. One snapshot is validated at
+        a time, so this waits for the previous one if it is still running
+        and returns its result; every submitted snapshot is validated.
+        '''
+        results = []
+        if self.pending is not None:
+            t0 = time.time()
+            results = self.poll(block=True)
+            print 'waited %.2f sec for the previous validation' % (time.time() - t0)
+        metrics.update_params(self.shared_params, params)
+        self.queue.put(uidx)
+        self.pending = (eidx, uidx, params, time.time())
+        return results
+
+    def poll(self, block=False):
+        '''
+        [(eidx, uidx, params, valid_err, valid_perp, test_err, test_perp,
+        scores, submit time, seconds of the validation)] of a finished
+        validation, or [].
+        '''
+        if self.pending is None:
+            return []
+        while True:
+            try:
+                rval = self.rqueue.get(block=block, timeout=1. if block else None)
+                break
+            except Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('validation process died, exit code %s' %
+                                       self.process.exitcode)
+                if not block:
+                    return []
+        eidx, uidx, params, submitted = self.pending
+        self.pending = None
+        assert rval[0] == uidx
+        return [(eidx, uidx, params) + tuple(rval[1:-1]) + (submitted, rval[-1])]
+
+    def close(self):
+        # results of a validation still running, the process is stopped
+        results = self.poll(block=True)
+        self.queue.put(None)
+        self.process.join()
+        return results